@@ -0,0 +1,300 @@
+import multiversx_utils_2 as mu
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from collections import Counter
+import argparse
+import subprocess
+import threading
+import tempfile
+import random
+import base64
+import shutil
+import time
+import json
+import sys
+import os
+
+# every host the fetch and market paths talk to is served by one local server, the first path
+# segment of a request tells which host it stands in for
+mock_hosts = ['api.elrond.com', 'metadata.cantinaroyale.io', 'api.xoxno.com', 'coindataflow.com']
+benchmark_collection = 'CRHEROES-9edff2'
+benchmark_whitelist = ['https://metadata.cantinaroyale.io/dynamic/', 'https://metadata.cantinaroyale.io/metadata/']
+data_folder_path = '../public/data'
+# legacy pagination can only reach this many items from each end of a collection
+api_window = 10000
+mock = {
+    'size': 1000,
+    'latency': 0,
+    'rate_429': 0,
+    'random': random.Random(0),
+    'lock': threading.Lock()
+}
+
+def b64(value):
+    return base64.b64encode(value.encode('utf-8')).decode('utf-8')
+
+def get_mock_nft(collection_name, nonce):
+    identifier = mu.get_identifier(collection_name, nonce)
+    return {
+        'identifier': identifier,
+        'collection': collection_name,
+        'attributes': b64(f'metadata:{nonce}.json'),
+        'nonce': nonce,
+        'type': 'NonFungibleESDT',
+        'name': f'Benchmark #{nonce}',
+        'creator': 'erd1qqqqqqqqqqqqqpgqbenchmarkcreator',
+        'royalties': 5,
+        'uris': [
+            b64(f'https://metadata.cantinaroyale.io/metadata/{nonce}.json'),
+            b64(f'https://metadata.cantinaroyale.io/dynamic/{identifier}'),
+            b64(f'https://ipfs.io/ipfs/benchmark/{nonce}.png')
+        ],
+        'url': f'https://media.elrond.com/nfts/asset/benchmark/{nonce}.png',
+        'media': [{'url': f'https://media.elrond.com/nfts/asset/benchmark/{nonce}.png', 'thumbnailUrl': f'https://media.elrond.com/nfts/thumbnail/{identifier}'}],
+        'metadata': {'attributes': [{'trait_type': 'Rarity Class', 'value': ['Common', 'Rare', 'Epic', 'Legendary'][nonce % 4]}]},
+        'owner': mu.xoxno_address if nonce % 5 == 0 else f'erd1benchmarkowner{nonce % 997}',
+        'rank': nonce
+    }
+
+def get_mock_traits(nonce):
+    return {'attributes': [{'trait_type': trait, 'value': f'{trait} {nonce % 7}'} for trait in mu.character_trait_attributes]}
+
+def get_mock_dynamic(nonce):
+    dynamic_data = {key: nonce % 20 for key in mu.character_dynamic_attributes if key not in ['level', 'character_tokens']}
+    dynamic_data['level'] = 1 + nonce % 20
+    dynamic_data['character_tokens'] = nonce * 37 % 50000
+    dynamic_data['talents'] = [{'name': name, 'value': nonce % 5} for name in ['Overachiever', 'Hodler', 'Grounded']]
+    return {'gameData': [{'dynamicData': dynamic_data}]}
+
+def get_mock_price(nonce):
+    if nonce % 5 != 0:
+        return {}
+    return {'saleInfo': {'paymentToken': 'EGLD', 'minBidShort': str(0.5 + nonce % 50 / 10)}}
+
+def route(path, query):
+    host, _, path = path.lstrip('/').partition('/')
+    path = '/' + path
+    size = mock['size']
+    if host == 'api.elrond.com':
+        parts = path.strip('/').split('/')
+        if len(parts) == 2 and parts[0] == 'collections':
+            return 200, {'collection': parts[1], 'type': 'NonFungibleESDT', 'name': parts[1], 'ticker': parts[1], 'owner': 'erd1benchmark'}
+        if len(parts) == 4 and parts[0] == 'collections' and parts[2:] == ['nfts', 'count']:
+            return 200, size
+        if len(parts) == 3 and parts[0] == 'collections' and parts[2] == 'nfts':
+            page_size = int(query.get('size', ['25'])[0])
+            if 'nonceAfter' in query:
+                nonces = range(max(1, int(query['nonceAfter'][0])), min(size, int(query['nonceBefore'][0])) + 1)
+                return 200, [get_mock_nft(parts[1], nonce) for nonce in nonces][:page_size]
+            start = int(query.get('from', ['0'])[0])
+            if start + page_size > api_window:
+                return 400, {'message': 'Result window is too large'}
+            nonces = range(1, size + 1) if query.get('order', ['asc'])[0] == 'asc' else range(size, 0, -1)
+            return 200, [get_mock_nft(parts[1], nonce) for nonce in nonces[start:start + page_size]]
+        if len(parts) == 2 and parts[0] == 'nfts':
+            nonce = int(parts[1].split('-')[-1], 16)
+            if nonce < 1 or nonce > size:
+                return 404, {'message': 'NFT not found'}
+            return 200, get_mock_nft('-'.join(parts[1].split('-')[:-1]), nonce)
+        if parts == ['nfts'] and 'identifiers' in query:
+            identifiers = query['identifiers'][0].split(',')
+            return 200, [get_mock_nft('-'.join(identifier.split('-')[:-1]), int(identifier.split('-')[-1], 16)) for identifier in identifiers if 1 <= int(identifier.split('-')[-1], 16) <= size]
+    if host == 'metadata.cantinaroyale.io':
+        if path.startswith('/metadata/'):
+            return 200, get_mock_traits(int(path.split('/')[-1].split('.')[0]))
+        if path.startswith('/dynamic/'):
+            return 200, get_mock_dynamic(int(path.split('-')[-1], 16))
+    if host == 'api.xoxno.com' and path.startswith('/nft/'):
+        return 200, get_mock_price(int(path.split('-')[-1], 16))
+    if host == 'api.xoxno.com' and path.startswith('/collection/') and path.endswith('/listings'):
+        skip = int(query.get('skip', ['0'])[0])
+        top = int(query.get('top', ['35'])[0])
+        listed = [nonce for nonce in range(1, size + 1) if get_mock_price(nonce) != {}]
+        collection_name = path.split('/')[2]
+        return 200, {
+            'resources': [{'identifier': mu.get_identifier(collection_name, nonce), **get_mock_price(nonce)} for nonce in listed[skip:skip + top]],
+            'resultsCount': len(listed),
+            'hasMoreResults': skip + top < len(listed)
+        }
+    if host == 'coindataflow.com':
+        return 200, '<html><script type="application/ld+json">{"currentExchangeRate": {"price": "0.00007"}}</script></html>'
+    return 404, {'message': 'not found'}
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out as separate writes, with nagle on keep-alive requests stall on delayed acks
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if mock['latency'] > 0:
+            time.sleep(mock['latency'])
+        with mock['lock']:
+            throttled = mock['random'].random() < mock['rate_429']
+        if throttled:
+            status, body = 429, {'message': 'Too Many Requests'}
+        else:
+            url = urlparse(self.path)
+            status, body = route(url.path, parse_qs(url.query))
+        content = (body if isinstance(body, str) else json.dumps(body)).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html' if isinstance(body, str) else 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        return
+
+def start_mock_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MockHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def point_at_mock_server(port, rate):
+    for host in mock_hosts:
+        mu.url_rewrites[f'https://{host}/'] = f'http://127.0.0.1:{port}/{host}/'
+        mu.rate_limiters[host] = mu.RateLimiter(rate, max_rate=rate)
+
+def get_raw_nfts(size):
+    raw_nfts = []
+    for nonce in range(1, size + 1):
+        nft = get_mock_nft(benchmark_collection, nonce)
+        nft['offchainData'] = {
+            'price': {'currency': 'EGLD', 'amount': 0.5 + nonce % 50 / 10} if nonce % 5 == 0 else {'currency': None, 'amount': None},
+            f'https://metadata.cantinaroyale.io/metadata/{nonce}.json': get_mock_traits(nonce),
+            f'https://metadata.cantinaroyale.io/dynamic/{nft["identifier"]}': get_mock_dynamic(nonce)
+        }
+        raw_nfts.append(nft)
+    return raw_nfts
+
+def write_market_stores(folder_path, size):
+    # the committed collections cycled up to size, so the market math sees real distributions;
+    # absent attributes are left out of a record the way parse_nft_data emits them
+    for collection_name in ['CRHEROES-9edff2', 'CRWEAPONS-e5ab49']:
+        with open(os.path.join(data_folder_path, collection_name, 'nfts.json')) as f:
+            records = [{key: value for key, value in nft.items() if key not in ['value', 'discount', 'progress'] and value is not None} for nft in json.load(f).values()]
+
+        def nfts():
+            for nonce in range(1, size + 1):
+                nft = dict(records[nonce % len(records)])
+                nft['identifier'] = mu.get_identifier(collection_name, nonce)
+                yield nft
+
+        filename = mu.get_stage_filename(folder_path, collection_name, 'nfts', 'parquet')
+        mu.write_parquet(filename, nfts())
+        check_parquet_columns(filename, nfts())
+    for filename in ['characters_upgrade.json', 'weapons_upgrade.json']:
+        shutil.copy(os.path.join(data_folder_path, filename), os.path.join(folder_path, filename))
+
+def check_parquet_columns(filename, records):
+    import pyarrow.parquet as pq
+    # every value of a sparse key has to survive the batched conversion
+    counts = Counter(key for record in records for key in record)
+    table = pq.read_table(filename)
+    for key, count in counts.items():
+        stored = len(table) - table.column(key).null_count if key in table.column_names else 0
+        if stored != count:
+            raise ValueError(f'{filename}: {key} has {stored} of {count} values')
+
+def run_benchmark(name, size, rate):
+    # returns the number of nfts handled, everything before the timer starts is setup
+    sleep_time = 1 / rate
+    if name == 'get_collection_nfts':
+        return lambda: len(mu.get_collection_nfts(benchmark_collection, sleep_time))
+    if name == 'get_collection_nfts_async':
+        return lambda: len(mu.get_collection_nfts_async(benchmark_collection, sleep_time))
+    if name == 'get_collection_nfts_master':
+        return lambda: len(mu.get_collection_nfts_master(benchmark_collection, sleep_time))
+    if name in ['get_collection_offchain_data', 'get_collection_offchain_data_async']:
+        collection_nfts = mu.CollectionNfts(get_mock_nft(benchmark_collection, nonce) for nonce in range(1, size + 1))
+        return lambda: len(getattr(mu, name)(collection_nfts, sleep_time=sleep_time, whitelist=benchmark_whitelist))
+    if name == 'get_collection_listings':
+
+        def get_collection_listings():
+            # counted as nfts priced, the per-nft path needs one request per listing for the same
+            mu.get_collection_listings(benchmark_collection, sleep_time)
+            return size
+
+        return get_collection_listings
+    if name == 'parse_nft_data':
+        raw_nfts = get_raw_nfts(size)
+        return lambda: len([mu.parse_nft_data(nft) for nft in raw_nfts])
+    if name == 'add_market_data':
+        folder_path = tempfile.mkdtemp(prefix='benchmark-')
+        write_market_stores(folder_path, size)
+
+        def add_market_data():
+            mu.add_market_data(folder_path, {'heroes': ['CRHEROES-9edff2'], 'weapons': ['CRWEAPONS-e5ab49']}, folder_path)
+            shutil.rmtree(folder_path)
+            return 2 * size
+
+        return add_market_data
+    raise ValueError(f'unknown benchmark {name}')
+
+def run_worker(name, size, port, rate):
+    point_at_mock_server(port, rate)
+    function = run_benchmark(name, size, rate)
+    with mu.measure_stage(name):
+        start = time.perf_counter()
+        count = function()
+        seconds = time.perf_counter() - start
+    stats = mu.run_stats[(name, None)]
+    return {
+        'benchmark': name,
+        'size': size,
+        'count': count,
+        'seconds': seconds,
+        'throughput': count / seconds if seconds > 0 else None,
+        'requests': sum(sum(statuses.values()) for statuses in stats['requests'].values()),
+        'retries': stats['retries'],
+        'bytes': stats['bytes'],
+        'peakRss': mu.get_peak_rss()
+    }
+
+benchmarks = [
+    'get_collection_nfts',
+    'get_collection_nfts_async',
+    'get_collection_nfts_master',
+    'get_collection_offchain_data',
+    'get_collection_offchain_data_async',
+    'get_collection_listings',
+    'parse_nft_data',
+    'add_market_data'
+]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the fetch and processing paths against a local mock of the MultiversX, metadata and xoxno APIs')
+    parser.add_argument('--benchmarks', nargs='+', choices=benchmarks, default=benchmarks)
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000, 100000])
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every response')
+    parser.add_argument('--rate-429', type=float, default=0, help='share of requests answered with 429')
+    parser.add_argument('--rate', type=float, default=1000, help='requests per second allowed per host')
+    parser.add_argument('--output', help='write the results to this json file')
+    parser.add_argument('--verbose', action='store_true', help='show the progress bars of the benchmarked code')
+    parser.add_argument('--worker', nargs=3, metavar=('BENCHMARK', 'SIZE', 'PORT'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker is not None:
+        # each benchmark runs in its own process so its peak RSS is its own
+        print(json.dumps(run_worker(args.worker[0], int(args.worker[1]), int(args.worker[2]), args.rate)))
+        sys.exit(0)
+    mock['latency'] = args.latency
+    mock['rate_429'] = args.rate_429
+    server = start_mock_server()
+    results = []
+    print(f"{'benchmark':<36} {'size':>7} {'count':>7} {'seconds':>9} {'nfts/s':>10} {'requests':>9} {'retries':>8} {'peak RSS':>9}")
+    for size in args.sizes:
+        mock['size'] = size
+        for name in args.benchmarks:
+            command = [sys.executable, os.path.abspath(__file__), '--worker', name, str(size), str(server.server_address[1]), '--rate', str(args.rate)]
+            process = subprocess.run(command, stdout=subprocess.PIPE, stderr=None if args.verbose else subprocess.DEVNULL, text=True)
+            if process.returncode != 0:
+                print(f'{name:<36} {size:>7} failed')
+                continue
+            result = json.loads(process.stdout.strip().splitlines()[-1])
+            results.append(result)
+            print(f"{name:<36} {size:>7} {result['count']:>7} {result['seconds']:>9.2f} {result['throughput']:>10.0f} {result['requests']:>9} {result['retries']:>8} {result['peakRss'] / 1024**2:>7.0f}MB")
+    server.shutdown()
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'latency': args.latency, 'rate429': args.rate_429, 'rate': args.rate, 'results': results}, f, indent=4)
@@ -1,42 +1,88 @@
 import multiversx_utils_2 as mu
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial
+import argparse
+import traceback
+import sys
 import json
 import os
 
 data_folder_path = '../public/data'
+# updater/script.sh points these outside the repository clone so they survive the nightly re-clone
+state_folder_path = os.environ.get('STATE_DIR', 'state')
+cache_folder_path = os.environ.get('CACHE_DIR', 'cache')
+cache_max_size = 512 * 1024 * 1024
 collections = ['CRMYTH-546419', 'CRWEAPONS-e5ab49', 'GSPACEAPE-08bc2b', 'CEA-2d29f9', 'CRHEROES-9edff2']
 operations = {
     'info': True,
     'nfts_raw': True,
     'nfts_processed': True,
+    # prices from bulk listing queries instead of one lookup per nft in nfts_raw; off until the
+    # xoxno listings endpoint is verified
+    'listings': False,
     'txs': False,
-    'market_data': True
+    'market_data': True,
+    'export': True,
+    'indexes': True
+}
+# --refresh-prices: new listings and crt/egld rate, value and discount recomputed on the stored
+# nfts and only the collection exports and market_data.json rewritten
+refresh_operations = ['listings', 'market_data', 'export']
+# market data is computed per group once every collection of the group is processed
+collection_groups = {
+    'genesis': ['CEA-2d29f9', 'GSPACEAPE-08bc2b'],
+    'heroes': ['CRHEROES-9edff2'],
+    'weapons': ['CRWEAPONS-e5ab49', 'CRMYTH-546419']
+}
+# fetched once per run by the ('market_data', 'rate') task, so every group is valued at the same rate
+exchange_rates = {}
+# global budget of tasks running at the same time
+max_jobs = 4
+fetch_engine = 'async'
+incremental = True
+offchain_ttl = 7 * 24 * 3600
+# long enough for the next nightly run to resume from the journal a crashed run left behind
+journal_max_age = 36 * 3600
+# seconds the run may spend on requests; past it nothing is fetched any more, offchain data falls
+# back to the previous run and is marked stale, and whatever was completed is still exported
+run_deadline = 6 * 3600
+# rows per collection page shard, the largest nftsPerPage option of the collection table
+shard_size = 100
+fetchers = {
+    'async': mu.get_collection_nfts_async,
+    'pages': mu.get_collection_nfts,
+    'master': mu.get_collection_nfts_master,
+    'slow': mu.get_collection_nfts_slow
+}
+# starting requests per second per host, shared by every collection served from the host
+host_rates = {
+    'api.elrond.com': 2.5,
+    'metadata.cantinaroyale.io': 1.6,
+    'metadata.verko.io': 5,
+    'api.xoxno.com': 1.6
 }
 params = {
     'CRMYTH-546419': {
-        'sleep_time': 0.6,
         'whitelist': ['https://metadata.cantinaroyale.io/dynamic/']
     },
     'CRWEAPONS-e5ab49': {
-        'sleep_time': 0.6,
         'whitelist': ['https://metadata.cantinaroyale.io/dynamic/']
     },
     'GSPACEAPE-08bc2b': {
-        'sleep_time': 0.2,
         'whitelist': ['https://metadata.verko.io/dynamic/']
     },
     'CEA-2d29f9': {
-        'sleep_time': 0.2,
         'whitelist': ['https://metadata.verko.io/dynamic/']
     },
     'CRCHAMPS-d0265d': {
-        'sleep_time': 0.6,
         'whitelist': ['https://metadata.cantinaroyale.io/dynamic/', 'https://metadata.cantinaroyale.io/metadata/']
     },
     'CRHEROES-9edff2': {
-        'sleep_time': 0.6,
         'whitelist': ['https://metadata.cantinaroyale.io/dynamic/', 'https://metadata.cantinaroyale.io/metadata/']
     }
 }
+mu.configure_cache(cache_folder_path, cache_max_size)
+mu.configure_rates(host_rates)
 
 def get_collection_info(collection_name, collection_folder_path):
     collection_info = mu.get_collection_info(collection_name)
@@ -45,54 +91,169 @@ def get_collection_info(collection_name, collection_folder_path):
         json.dump(collection_info, f, indent=4)
     return
 
-def get_collection_nfts_raw(collection_name, collection_folder_path, sleep_time, whitelist):
-    collection_nfts = mu.get_collection_nfts(collection_name)
-    collection_offchain_data = mu.get_collection_offchain_data(collection_nfts, sleep_time=sleep_time, whitelist=whitelist)
-    for identifier in collection_nfts:
-        collection_nfts[identifier]['offchainData'] = collection_offchain_data[identifier]
-    filename = os.path.join(collection_folder_path, 'nfts_raw.json')
-    with open(filename, 'w') as f:
-        json.dump(collection_nfts, f, indent=4)
+def get_collection_nfts_raw(collection_name, collection_folder_path, whitelist, fetch_prices):
+    collection_nfts = fetchers[fetch_engine](collection_name)
+    state_filename = os.path.join(state_folder_path, f'{collection_name}.json')
+    sync_state = mu.load_sync_state(state_filename) if incremental else None
+    # offchain data is journaled as it arrives, a run that dies here resumes from the journal
+    journal_filename = mu.get_stage_filename(state_folder_path, collection_name, 'offchain')
+    if fetch_engine == 'async':
+        collection_offchain_data = mu.iter_collection_offchain_data_async(collection_nfts, sync_state, ttl=offchain_ttl, whitelist=whitelist, journal_filename=journal_filename, journal_max_age=journal_max_age, fetch_prices=fetch_prices)
+    elif incremental:
+        collection_offchain_data = mu.get_collection_offchain_data_incremental(collection_nfts, sync_state, ttl=offchain_ttl, whitelist=whitelist, journal_filename=journal_filename, journal_max_age=journal_max_age, fetch_prices=fetch_prices).items()
+    else:
+        collection_offchain_data = mu.get_collection_offchain_data(collection_nfts, whitelist=whitelist, journal_filename=journal_filename, journal_max_age=journal_max_age, fetch_prices=fetch_prices).items()
+    # records are written one per line as their offchain data arrives
+    collection_nfts_raw = ({**collection_nfts[identifier], 'offchainData': offchain_data} for identifier, offchain_data in collection_offchain_data)
+    mu.write_jsonl(mu.get_stage_filename(state_folder_path, collection_name, 'nfts_raw'), collection_nfts_raw)
+    if incremental:
+        mu.save_sync_state(state_filename, sync_state)
+    # everything journaled is now in the stage file and the sync state
+    if os.path.exists(journal_filename):
+        os.remove(journal_filename)
     return
 
-def get_collection_nfts_processed(collection_name, collection_folder_path):
-    filename = os.path.join(collection_folder_path, 'nfts_raw.json')
-    with open(filename, 'r') as f:
-        collection_nfts = json.load(f)
-    collection_nfts_processed = {}
-    for identifier, nft in collection_nfts.items():
-        collection_nfts_processed[identifier] = mu.parse_nft_data(nft)
-    filename = os.path.join(collection_folder_path, 'nfts.json')
-    with open(filename, 'w') as f:
-        json.dump(collection_nfts_processed, f, indent=4)
-    os.remove(os.path.join(collection_folder_path, 'nfts_raw.json'))
+def get_collection_nfts_processed(collection_name, collection_folder_path, keep_prices):
+    filename_raw = mu.get_stage_filename(state_folder_path, collection_name, 'nfts_raw')
+    filename = mu.get_stage_filename(state_folder_path, collection_name, 'nfts', 'parquet')
+    # when nfts_raw left the prices to the listings stage the previous store's prices are kept, so
+    # a listings stage that fails still leaves the last known prices
+    prices = mu.read_collection_prices(state_folder_path, collection_name) if keep_prices and os.path.exists(filename) else {}
+    mu.write_parquet(filename, ({**record, **prices.get(record['identifier'], {})} for record in map(mu.parse_nft_data, mu.read_jsonl(filename_raw))))
+    remove_market_columns(collection_name)
+    os.remove(filename_raw)
+    return
+
+def get_collection_listings(collection_name, collection_folder_path):
+    # without listings the store keeps the prices it has, market data and the export still go out
+    try:
+        listings = mu.get_collection_listings(collection_name)
+    except mu.FetchError as e:
+        print(f'{collection_name}: no listings ({e}), keeping the stored prices')
+        mu.record_stale()
+        return
+    mu.write_collection_listings(state_folder_path, collection_name, listings)
+    remove_market_columns(collection_name)
+    return
+
+def remove_market_columns(collection_name):
+    # market columns computed on the previous working copy no longer apply
+    market_filename = mu.get_stage_filename(state_folder_path, collection_name, 'market', 'parquet')
+    if os.path.exists(market_filename):
+        os.remove(market_filename)
     return
 
 def get_collection_txs(collection_name, collection_folder_path):
-    collection_txs = mu.get_collection_txs(collection_name)
+    identifiers = sorted(mu.get_collection_identifiers(state_folder_path, collection_name))
     filename = os.path.join(collection_folder_path, 'txs.json')
-    with open(filename, 'w') as f:
-        json.dump(collection_txs, f, indent=4)
+    journal_filename = os.path.join(state_folder_path, f'{collection_name}.txs.jsonl')
+    mu.get_collection_txs(collection_name, identifiers, filename, journal_filename)
     return
 
-for collection_name in collections:
-    collection_folder_path = os.path.join(data_folder_path, collection_name)
-    if not os.path.exists(collection_folder_path):
-        os.makedirs(collection_folder_path)
-    if operations['info']:
-        get_collection_info(collection_name, collection_folder_path)
-    if operations['nfts_raw']:
-        get_collection_nfts_raw(collection_name, collection_folder_path, params[collection_name]['sleep_time'], params[collection_name]['whitelist'])
-    if operations['nfts_processed']:
-        get_collection_nfts_processed(collection_name, collection_folder_path)
-    if operations['txs']:
-        get_collection_txs(collection_name, collection_folder_path)
-
-if operations['market_data']:
-    data_folder_path = '../public/data'
-    collections = {
-    "genesis": ["CEA-2d29f9", "GSPACEAPE-08bc2b"],
-    "heroes": ["CRHEROES-9edff2"],
-    "weapons": ["CRWEAPONS-e5ab49", "CRMYTH-546419"],
-    }
-    mu.add_market_data(data_folder_path, collections)
+def export_collection_nfts(collection_name, collection_folder_path):
+    mu.export_collection_nfts(state_folder_path, collection_name, os.path.join(collection_folder_path, 'nfts.json'))
+    mu.export_collection_shards(state_folder_path, collection_name, os.path.join(collection_folder_path, 'shards'), shard_size)
+    return
+
+def get_exchange_rate():
+    exchange_rates['CRT/EGLD'] = mu.get_crt_egld_rate(data_folder_path)
+    return
+
+def get_market_data(group):
+    mu.add_market_data(data_folder_path, {group: collection_groups[group]}, state_folder_path, crt_egld_rate=exchange_rates['CRT/EGLD'])
+    return
+
+def get_stored_collections(selected_collections):
+    return [collection_name for collection_name in selected_collections if os.path.exists(mu.get_stage_filename(state_folder_path, collection_name, 'nfts', 'parquet'))]
+
+def export_indexes():
+    mu.export_indexes(state_folder_path, get_stored_collections(collections), os.path.join(data_folder_path, 'indexes'), shard_size)
+    return
+
+def build_tasks(selected_collections, selected_operations):
+    # (operation, collection or group) -> (function, dependencies); dependencies on tasks
+    # that are not part of this run are dropped
+    groups = {collection_name: group for group, group_collections in collection_groups.items() for collection_name in group_collections}
+    tasks = {}
+    for collection_name in selected_collections:
+        collection_folder_path = os.path.join(data_folder_path, collection_name)
+        os.makedirs(collection_folder_path, exist_ok=True)
+        tasks[('info', collection_name)] = (partial(get_collection_info, collection_name, collection_folder_path), [])
+        tasks[('nfts_raw', collection_name)] = (partial(get_collection_nfts_raw, collection_name, collection_folder_path, params[collection_name]['whitelist'], 'listings' not in selected_operations), [])
+        tasks[('nfts_processed', collection_name)] = (partial(get_collection_nfts_processed, collection_name, collection_folder_path, 'listings' in selected_operations), [('nfts_raw', collection_name)])
+        tasks[('listings', collection_name)] = (partial(get_collection_listings, collection_name, collection_folder_path), [('nfts_processed', collection_name)])
+        tasks[('txs', collection_name)] = (partial(get_collection_txs, collection_name, collection_folder_path), [('nfts_processed', collection_name)])
+        tasks[('export', collection_name)] = (partial(export_collection_nfts, collection_name, collection_folder_path), [('nfts_processed', collection_name), ('listings', collection_name), ('market_data', groups.get(collection_name))])
+    tasks[('market_data', 'rate')] = (get_exchange_rate, [])
+    for group, group_collections in collection_groups.items():
+        if any(collection_name in selected_collections for collection_name in group_collections):
+            tasks[('market_data', group)] = (partial(get_market_data, group), [('market_data', 'rate'), *[(operation, collection_name) for collection_name in group_collections for operation in ['nfts_processed', 'listings']]])
+    tasks[('indexes', None)] = (export_indexes, [('export', collection_name) for collection_name in selected_collections])
+    tasks = {name: task for name, task in tasks.items() if name[0] in selected_operations}
+    return {name: (function, [dependency for dependency in dependencies if dependency in tasks]) for name, (function, dependencies) in tasks.items()}
+
+def run_task(name, function):
+    with mu.measure_stage(*name):
+        function()
+    return
+
+def run_tasks(tasks, max_workers):
+    # a task starts as soon as all of its dependencies are done and is skipped when one failed
+    remaining = dict(tasks)
+    done = set()
+    failed = {}
+    running = {}
+    with ThreadPoolExecutor(max_workers) as executor:
+        while len(remaining) > 0 or len(running) > 0:
+            changed = True
+            while changed:
+                changed = False
+                for name, (function, dependencies) in list(remaining.items()):
+                    if any(dependency in failed for dependency in dependencies):
+                        failed[name] = None
+                        del remaining[name]
+                        changed = True
+                    elif all(dependency in done for dependency in dependencies):
+                        running[executor.submit(run_task, name, function)] = name
+                        del remaining[name]
+            if len(running) == 0:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                if future.exception() is None:
+                    done.add(name)
+                else:
+                    failed[name] = future.exception()
+    return failed
+
+parser = argparse.ArgumentParser(description='Fetch, process and export the collections in public/data')
+parser.add_argument('--collections', nargs='+', choices=collections, default=collections)
+parser.add_argument('--operations', nargs='+', choices=list(operations), default=[operation for operation, enabled in operations.items() if enabled])
+parser.add_argument('--jobs', type=int, default=max_jobs)
+parser.add_argument('--deadline', type=float, default=run_deadline)
+parser.add_argument('--refresh-prices', action='store_true', help='only refresh listings and market data of the collections already processed')
+args = parser.parse_args()
+mu.set_run_deadline(args.deadline)
+if args.refresh_prices:
+    args.collections = get_stored_collections(args.collections)
+    args.operations = refresh_operations
+
+failed = run_tasks(build_tasks(args.collections, args.operations), args.jobs)
+
+mu.save_cache()
+mu.print_connection_stats()
+mu.print_cache_stats()
+mu.print_run_stats()
+# the nightly report is kept next to market_data.json, so the nightly commit tracks it over time; a
+# price refresh keeps its own in the state folder, or its timestamps alone would make every hourly
+# publish commit
+mu.write_run_report(os.path.join(state_folder_path, 'refresh_report.json') if args.refresh_prices else os.path.join(data_folder_path, 'run_report.json'))
+for name, error in failed.items():
+    if error is None:
+        print(f'{name} skipped, a dependency failed')
+    else:
+        print(f'{name} failed')
+        traceback.print_exception(error)
+if len(failed) > 0:
+    sys.exit(1)
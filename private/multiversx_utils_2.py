@@ -1,164 +1,865 @@
 import requests 
+from requests.adapters import HTTPAdapter
+import threading
+import contextvars
+from contextlib import contextmanager
+import resource
+import sys
 import time
+import random
+from email.utils import parsedate_to_datetime
 from tqdm import tqdm
-from fake_useragent import UserAgent
-from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import defaultdict, Counter
+from collections.abc import Mapping
+from sortedcontainers import SortedDict
+from urllib.parse import urlparse
+import asyncio
+import queue
 import base64
-from selenium import webdriver
-from selenium_stealth import stealth
-from selenium.webdriver.common.by import By
+import hashlib
+import zlib
+from functools import lru_cache
+from itertools import islice
 import os
+import shutil
+import filecmp
 import json
-import pandas as pd
-import numpy as np
-from bs4 import BeautifulSoup
-
-def clear_keys(dictionary):
-    keys = {}
-    for nft in dictionary.values():
-        for key in nft.keys():
-            if key not in keys:
-                keys[key] = 0
-            keys[key] += 1
-    dictionary_length = len(dictionary)
-    key_to_remove = [key for key, count in keys.items() if count != dictionary_length]
-    for identifier in dictionary:
-        for key in key_to_remove:
-            if key in dictionary[identifier]:
-                del dictionary[identifier][key]
-    return dictionary
+# pandas, numpy, pyarrow, bs4, selenium and fake_useragent are imported where they are used,
+# so the fetch stages start without loading them
 
-def get_total_nfts(collection_name, sleep_time=0.4):
-    user_agent = UserAgent()
-    while True:
-        try:
-            url = f'https://api.elrond.com/collections/{collection_name}/nfts/count'
-            headers = {'User-Agent': user_agent.random}
-            response = requests.get(url, headers=headers)
-            if response.status_code == 200:
-                total_nfts = response.json()
-                break
-            elif response.status_code == 404:
+class CollectionNfts(Mapping):
+    # identifier -> nft, held as one value list per key instead of one dict per nft; a key
+    # missing from a new nft is dropped as soon as that nft arrives, so only keys every nft
+    # has are kept, and identifiers stay sorted as they are added. lookups build a new dict,
+    # callers read an nft once and keep it
+    __slots__ = ('columns', 'rows')
+
+    def __init__(self, nfts=()):
+        self.columns = None
+        self.rows = SortedDict()
+        self.extend(nfts)
+
+    def add(self, nft):
+        row = self.rows.get(nft['identifier'])
+        if row is not None:
+            # an update keeps the current value of a key it lacks
+            for key, values in self.columns.items():
+                if key in nft:
+                    values[row] = nft[key]
+            return
+        if self.columns is None:
+            self.columns = {key: [] for key in nft}
+        else:
+            for key in [key for key in self.columns if key not in nft]:
+                del self.columns[key]
+        self.rows[nft['identifier']] = len(self.rows)
+        for key, values in self.columns.items():
+            values.append(nft[key])
+
+    def extend(self, nfts):
+        for nft in nfts:
+            self.add(nft)
+
+    def __getitem__(self, identifier):
+        row = self.rows[identifier]
+        return {key: values[row] for key, values in self.columns.items()}
+
+    def __contains__(self, identifier):
+        return identifier in self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+default_pool_size = 10
+pool_sizes = {
+    'api.elrond.com': 16,
+    'metadata.cantinaroyale.io': 16,
+    'metadata.verko.io': 16,
+    'api.xoxno.com': 8
+}
+sessions = {}
+sessions_lock = threading.Lock()
+# requests per second each host's limiter starts at before adapting, set with configure_rates; a
+# host not listed starts at 1/sleep_time of its first request, or default_rate
+host_rates = {}
+default_rate = 2.5
+backoff_base = 0.5
+backoff_cap = 60
+# every request gives up after max_attempts tries of at most request_timeout seconds each, a host
+# whose last breaker_threshold attempts all failed is skipped for breaker_cooldown seconds, and
+# past run_deadline (time.monotonic) nothing is requested at all
+max_attempts = 6
+request_timeout = 30
+breaker_threshold = 10
+breaker_cooldown = 300
+breaker_poll_interval = 5
+run_deadline = None
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+circuit_breakers = {}
+circuit_breakers_lock = threading.Lock()
+# sockets and limiter locks must never be shared with forked worker processes
+os.register_at_fork(after_in_child=sessions.clear)
+os.register_at_fork(after_in_child=rate_limiters.clear)
+os.register_at_fork(after_in_child=circuit_breakers.clear)
+
+class FetchError(Exception):
+    pass
+
+class RateLimiter:
+    def __init__(self, rate, min_rate=0.1, max_rate=50, increase=1, decrease=0.5, decrease_interval=1):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.decrease_interval = decrease_interval
+        self.last_decrease = 0
+        self.tokens = 1
+        self.last = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(1, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def update(self, response):
+        retry_after = get_retry_after(response)
+        # additive increase of about `increase` req/s per second, multiplicative decrease at most
+        # once per interval so that a burst of in-flight 429s counts as a single signal
+        with self.lock:
+            now = time.monotonic()
+            if response.status_code == 429 or retry_after is not None:
+                if now - self.last_decrease >= self.decrease_interval:
+                    self.rate = max(self.min_rate, self.rate * self.decrease)
+                    self.last_decrease = now
+                if retry_after is not None:
+                    self.blocked_until = max(self.blocked_until, now + retry_after)
+            elif response.status_code in [200, 304]:
+                self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+def get_retry_after(response):
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def get_rate_limiter(host, sleep_time=None):
+    with rate_limiters_lock:
+        if host not in rate_limiters:
+            rate_limiters[host] = RateLimiter(host_rates.get(host) or (1 / sleep_time if sleep_time else default_rate))
+        return rate_limiters[host]
+
+def configure_rates(rates):
+    with rate_limiters_lock:
+        for host, rate in rates.items():
+            host_rates[host] = rate
+            rate_limiters.pop(host, None)
+
+class CircuitBreaker:
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.down = False
+        self.lock = threading.Lock()
+
+    def get_wait(self):
+        # seconds left before a request may go out, 0 when it may, None when the host is down;
+        # once the cooldown is over a single probe goes through, its outcome closes the circuit
+        # or marks the host down, and requests fail fast until a later probe succeeds
+        with self.lock:
+            if self.opened_at is None:
+                return 0
+            elapsed = time.monotonic() - self.opened_at
+            if elapsed >= self.cooldown:
+                self.opened_at = time.monotonic()
+                self.probing = True
+                return 0
+            if self.down:
                 return None
+            return self.cooldown - elapsed
+
+    def update(self, ok):
+        with self.lock:
+            if ok:
+                self.failures = 0
+                self.opened_at = None
+                self.probing = False
+                self.down = False
             else:
-                time.sleep(sleep_time)
-        except:
-            time.sleep(sleep_time)
-    return total_nfts
+                self.failures += 1
+                if self.probing:
+                    self.probing = False
+                    self.down = True
+                if self.failures >= self.threshold:
+                    self.opened_at = time.monotonic()
 
-def get_collection_info(collection_name, sleep_time=0.4):
-    ua = UserAgent()
+def get_circuit_breaker(host):
+    with circuit_breakers_lock:
+        if host not in circuit_breakers:
+            circuit_breakers[host] = CircuitBreaker(breaker_threshold, breaker_cooldown)
+        return circuit_breakers[host]
+
+def set_run_deadline(seconds):
+    global run_deadline
+    run_deadline = time.monotonic() + seconds if seconds is not None else None
+
+def get_time_left():
+    return run_deadline - time.monotonic() if run_deadline is not None else None
+
+def start_attempt(url):
+    # seconds to wait before trying again, 0 to go ahead; a request to a host whose circuit just
+    # opened waits for the probe at the end of the cooldown, polling so it goes as soon as the
+    # probe closes the circuit, and fails once the probe finds the host down or the cooldown
+    # outlasts the run deadline
+    time_left = get_time_left()
+    if time_left is not None and time_left <= 0:
+        raise FetchError(f'{url}: run deadline passed')
+    wait = get_circuit_breaker(get_host(url)).get_wait()
+    if wait is None:
+        raise FetchError(f'{url}: circuit open for {get_host(url)}, host down')
+    if time_left is not None and wait >= time_left:
+        raise FetchError(f'{url}: circuit open for {get_host(url)} past the run deadline')
+    return min(wait, breaker_poll_interval)
+
+def finish_attempt(url, response, accept):
+    # only errors and 5xx count against the host, a 429 is the rate limiter's business but still
+    # shows the host is up
+    if response is None:
+        get_circuit_breaker(get_host(url)).update(False)
+        return False
+    get_circuit_breaker(get_host(url)).update(response.status_code < 500)
+    return response.status_code in accept
+
+def get_retry_delay(url, attempt):
+    if attempt + 1 >= max_attempts:
+        raise FetchError(f'{url}: gave up after {attempt + 1} attempts')
+    delay = get_backoff(attempt)
+    time_left = get_time_left()
+    return min(delay, max(0, time_left)) if time_left is not None else delay
+
+def get_with_retries(url, user_agent, sleep_time=0.4, accept=(200, 404)):
+    # the first response with a status in accept, FetchError once the retry policy gives up
+    attempt = 0
     while True:
+        wait = start_attempt(url)
+        if wait > 0:
+            time.sleep(wait)
+            continue
         try:
-            url = f'https://api.elrond.com/collections/{collection_name}'
-            headers = {'User-Agent': ua.random}
-            response = requests.get(url, headers=headers)
-            if response.status_code == 200:
-                collection_info = response.json()
-                break
-            if response.status_code == 404:
-                return None
+            response = http_get(url, headers={'User-Agent': user_agent.random}, sleep_time=sleep_time, timeout=request_timeout)
+        except Exception:
+            response = None
+        if finish_attempt(url, response, accept):
+            return response
+        time.sleep(get_retry_delay(url, attempt))
+        attempt += 1
+
+async def async_get_with_retries(url, user_agent, sleep_time=0.4, accept=(200, 404)):
+    attempt = 0
+    while True:
+        wait = start_attempt(url)
+        if wait > 0:
+            await asyncio.sleep(wait)
+            continue
+        try:
+            response = await asyncio.to_thread(http_get, url, headers={'User-Agent': user_agent.random}, sleep_time=sleep_time, timeout=request_timeout)
+        except Exception:
+            response = None
+        if finish_attempt(url, response, accept):
+            return response
+        await asyncio.sleep(get_retry_delay(url, attempt))
+        attempt += 1
+
+def get_backoff(attempt):
+    # every retry path sleeps for a backoff, so this is where retries are counted
+    record_retry()
+    return random.uniform(0, min(backoff_cap, backoff_base * 2 ** attempt))
+
+def get_host(url):
+    return urlparse(url).netloc
+
+def get_session(host):
+    with sessions_lock:
+        if host not in sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_sizes.get(host, default_pool_size), pool_block=True)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            sessions[host] = session
+        return sessions[host]
+
+user_agent_pool = None
+user_agent_lock = threading.Lock()
+
+def get_user_agent():
+    # loading the browser list is the slow part of fake_useragent, so every fetch in the
+    # process shares one pool built on first use
+    global user_agent_pool
+    with user_agent_lock:
+        if user_agent_pool is None:
+            from fake_useragent import UserAgent
+            user_agent_pool = UserAgent()
+        return user_agent_pool
+
+def configure_pools(sizes):
+    with sessions_lock:
+        for host, size in sizes.items():
+            pool_sizes[host] = size
+            if host in sessions:
+                sessions.pop(host).close()
+
+# documents under these prefixes never change once published
+static_offchain_prefixes = ['https://metadata.cantinaroyale.io/metadata/']
+cache_folder_path = None
+cache_max_size = 512 * 1024 * 1024
+cache_index = {}
+cache_size = 0
+cache_stats = {'hits': 0, 'revalidated': 0, 'misses': 0, 'bytesSaved': 0}
+cache_lock = threading.Lock()
+
+def configure_cache(folder_path, max_size=512*1024*1024):
+    global cache_folder_path, cache_max_size, cache_index, cache_size
+    cache_folder_path = folder_path
+    cache_max_size = max_size
+    os.makedirs(os.path.join(folder_path, 'objects'), exist_ok=True)
+    filename = os.path.join(folder_path, 'index.json')
+    if os.path.exists(filename):
+        with open(filename, 'r') as f:
+            cache_index = json.load(f)
+    else:
+        cache_index = {'urls': {}, 'objects': {}}
+    reconcile_cache()
+    cache_size = sum([cache_object['size'] for cache_object in cache_index['objects'].values()])
+
+def reconcile_cache():
+    # the index is only saved at the end of a run, so after a crash the blob folder holds objects
+    # the saved index does not know about; they are removed and the references rebuilt from the urls
+    objects_folder_path = os.path.join(cache_folder_path, 'objects')
+    paths = {}
+    for folder in os.listdir(objects_folder_path):
+        for name in os.listdir(os.path.join(objects_folder_path, folder)):
+            path = os.path.join(objects_folder_path, folder, name)
+            if name.endswith('.z'):
+                paths[name[:-2]] = path
             else:
-                time.sleep(sleep_time)
-        except:
-            time.sleep(sleep_time)
+                os.remove(path)
+    cache_index['urls'] = {url: entry for url, entry in cache_index['urls'].items() if entry['digest'] in paths}
+    references = Counter(entry['digest'] for entry in cache_index['urls'].values())
+    cache_index['objects'] = {digest: {'size': os.path.getsize(path), 'references': references[digest]} for digest, path in paths.items() if digest in references}
+    for digest, path in paths.items():
+        if digest not in references:
+            os.remove(path)
+
+def save_cache():
+    if cache_folder_path is None:
+        return
+    filename = os.path.join(cache_folder_path, 'index.json')
+    with cache_lock:
+        with open(f'{filename}.tmp', 'w') as f:
+            json.dump(cache_index, f)
+    os.replace(f'{filename}.tmp', filename)
+
+def get_cache_object_path(digest):
+    return os.path.join(cache_folder_path, 'objects', digest[:2], f'{digest}.z')
+
+def read_cache(url):
+    with cache_lock:
+        entry = cache_index['urls'].get(url)
+        if entry is None:
+            return None, None
+        entry['accessedAt'] = time.time()
+    try:
+        with open(get_cache_object_path(entry['digest']), 'rb') as f:
+            return entry, zlib.decompress(f.read())
+    except (OSError, zlib.error):
+        return None, None
+
+def write_cache(url, response):
+    global cache_size
+    body = response.content
+    digest = hashlib.sha256(body).hexdigest()
+    path = get_cache_object_path(digest)
+    compressed = zlib.compress(body, 6)
+    # checked, written and referenced under the lock, so a concurrent release of the same digest
+    # cannot delete the object between the write and the reference
+    with cache_lock:
+        if digest not in cache_index['objects']:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(f'{path}.tmp', 'wb') as f:
+                f.write(compressed)
+            os.replace(f'{path}.tmp', path)
+            cache_index['objects'][digest] = {'size': len(compressed), 'references': 0}
+            cache_size += len(compressed)
+        cache_index['objects'][digest]['references'] += 1
+        previous = cache_index['urls'].get(url)
+        if previous is not None:
+            release_cache_object(previous['digest'])
+        cache_index['urls'][url] = {
+            'digest': digest,
+            'etag': response.headers.get('ETag'),
+            'lastModified': response.headers.get('Last-Modified'),
+            'accessedAt': time.time()
+        }
+        evict_cache()
+
+def release_cache_object(digest):
+    global cache_size
+    cache_object = cache_index['objects'][digest]
+    cache_object['references'] -= 1
+    if cache_object['references'] == 0:
+        del cache_index['objects'][digest]
+        cache_size -= cache_object['size']
+        try:
+            os.remove(get_cache_object_path(digest))
+        except OSError:
+            pass
+
+def evict_cache():
+    if cache_size <= cache_max_size:
+        return
+    for url, entry in sorted(cache_index['urls'].items(), key=lambda x: x[1]['accessedAt']):
+        if cache_size <= cache_max_size:
+            break
+        del cache_index['urls'][url]
+        release_cache_object(entry['digest'])
+
+def build_cached_response(url, entry, body):
+    response = requests.models.Response()
+    response.status_code = 200
+    response.url = url
+    response._content = body
+    response.encoding = 'utf-8'
+    if entry['etag'] is not None:
+        response.headers['ETag'] = entry['etag']
+    if entry['lastModified'] is not None:
+        response.headers['Last-Modified'] = entry['lastModified']
+    return response
+
+def count_cache(key, saved=0):
+    with cache_lock:
+        cache_stats[key] += 1
+        cache_stats['bytesSaved'] += saved
+
+def print_cache_stats():
+    if cache_folder_path is None:
+        return
+    print(f"cache: {cache_stats['hits']} hits, {cache_stats['revalidated']} revalidated, {cache_stats['misses']} misses, {cache_stats['bytesSaved'] / 1024**2:.1f} MB saved, {cache_size / 1024**2:.1f} MB on disk")
+
+# (stage, collection) of the running task; asyncio.to_thread copies it into worker threads,
+# threads started here get it through contextvars.copy_context
+current_stage = contextvars.ContextVar('current_stage', default=('other', None))
+run_stats = {}
+run_stats_lock = threading.Lock()
+run_started_at = time.time()
+
+def get_stage_stats(label):
+    # callers hold run_stats_lock
+    if label not in run_stats:
+        run_stats[label] = {
+            'stage': label[0],
+            'collection': label[1],
+            'status': None,
+            'wallTime': 0,
+            'requests': defaultdict(lambda: defaultdict(int)),
+            'retries': 0,
+            'stale': 0,
+            'bytes': 0,
+            'maxRss': 0
+        }
+    return run_stats[label]
+
+def record_request(host, status, size=0):
+    with run_stats_lock:
+        stats = get_stage_stats(current_stage.get())
+        stats['requests'][host][str(status)] += 1
+        stats['bytes'] += size
+
+def record_retry():
+    with run_stats_lock:
+        get_stage_stats(current_stage.get())['retries'] += 1
+
+def record_stale():
+    with run_stats_lock:
+        get_stage_stats(current_stage.get())['stale'] += 1
+
+def get_peak_rss():
+    # process-wide high-water mark, ru_maxrss is in KB on linux and in bytes on macos
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+def get_current_rss():
+    # /proc is linux only, elsewhere the high-water mark stands in
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return get_peak_rss()
+
+# a stage's maxRss is the largest process rss sampled while it ran, stages running at the same
+# time see each other's memory too
+rss_sample_interval = 0.2
+running_stages = set()
+rss_sampler = []
+os.register_at_fork(after_in_child=rss_sampler.clear)
+
+def sample_rss():
+    while True:
+        rss = get_current_rss()
+        with run_stats_lock:
+            for label in running_stages:
+                run_stats[label]['maxRss'] = max(run_stats[label]['maxRss'], rss)
+        time.sleep(rss_sample_interval)
+
+@contextmanager
+def measure_stage(stage, collection=None):
+    token = current_stage.set((stage, collection))
+    start = time.monotonic()
+    status = 'failed'
+    with run_stats_lock:
+        stats = get_stage_stats((stage, collection))
+        stats['maxRss'] = max(stats['maxRss'], get_current_rss())
+        running_stages.add((stage, collection))
+        if len(rss_sampler) == 0:
+            rss_sampler.append(threading.Thread(target=sample_rss, daemon=True))
+            rss_sampler[0].start()
+    try:
+        yield
+        status = 'ok'
+    finally:
+        with run_stats_lock:
+            running_stages.discard((stage, collection))
+            stats['status'] = status
+            stats['wallTime'] += time.monotonic() - start
+            stats['maxRss'] = max(stats['maxRss'], get_current_rss())
+        current_stage.reset(token)
+
+def write_run_report(filename):
+    with run_stats_lock:
+        stages = [dict(stats) for stats in run_stats.values()]
+    report = {
+        'startedAt': run_started_at,
+        'finishedAt': time.time(),
+        'wallTime': time.time() - run_started_at,
+        # high-water mark of the whole process
+        'peakRss': get_peak_rss(),
+        'stages': stages,
+        'cache': dict(cache_stats),
+        'connections': get_connection_stats()
+    }
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    with open(f'{filename}.tmp', 'w') as f:
+        json.dump(report, f, indent=4)
+    os.replace(f'{filename}.tmp', filename)
+
+def print_run_stats():
+    with run_stats_lock:
+        for stats in run_stats.values():
+            requests_count = sum(sum(statuses.values()) for statuses in stats['requests'].values())
+            print(f"{stats['stage']} {stats['collection'] or ''}: {stats['status']}, {stats['wallTime']:.1f}s, {requests_count} requests, {stats['retries']} retries, {stats['stale']} stale, {stats['bytes'] / 1024**2:.1f} MB, max RSS {stats['maxRss'] / 1024**2:.0f} MB")
+
+# prefix -> replacement applied to a request url right before it is sent, hosts, cache and
+# parsing keep seeing the original url (benchmark.py points every host at a local server)
+url_rewrites = {}
+
+def rewrite_url(url):
+    for prefix, replacement in url_rewrites.items():
+        if url.startswith(prefix):
+            return replacement + url[len(prefix):]
+    return url
+
+def http_get(url, headers=None, sleep_time=None, **kwargs):
+    host = get_host(url)
+    entry, body = read_cache(url) if cache_folder_path is not None else (None, None)
+    if entry is not None and any([url.startswith(p) for p in static_offchain_prefixes]):
+        count_cache('hits', len(body))
+        record_request(host, 'cached')
+        return build_cached_response(url, entry, body)
+    headers = dict(headers or {})
+    if entry is not None and entry['etag'] is not None:
+        headers['If-None-Match'] = entry['etag']
+    if entry is not None and entry['lastModified'] is not None:
+        headers['If-Modified-Since'] = entry['lastModified']
+    rate_limiter = get_rate_limiter(host, sleep_time)
+    rate_limiter.acquire()
+    try:
+        response = get_session(host).get(rewrite_url(url), headers=headers, **kwargs)
+    except Exception:
+        record_request(host, 'error')
+        raise
+    record_request(host, response.status_code, len(response.content))
+    rate_limiter.update(response)
+    if cache_folder_path is None:
+        return response
+    if response.status_code == 304 and entry is not None:
+        count_cache('revalidated', len(body))
+        return build_cached_response(url, entry, body)
+    if response.status_code == 200:
+        count_cache('misses')
+        if response.headers.get('ETag') or response.headers.get('Last-Modified') or any([url.startswith(p) for p in static_offchain_prefixes]):
+            write_cache(url, response)
+    return response
+
+def get_connection_stats():
+    connection_stats = {}
+    with sessions_lock:
+        for host, session in sessions.items():
+            pool_manager = session.get_adapter(f'https://{host}').poolmanager
+            connection_stats[host] = {'requests': 0, 'connections': 0}
+            for key in pool_manager.pools.keys():
+                pool = pool_manager.pools.get(key)
+                if pool is not None:
+                    connection_stats[host]['requests'] += pool.num_requests
+                    connection_stats[host]['connections'] += pool.num_connections
+            connection_stats[host]['reused'] = connection_stats[host]['requests'] - connection_stats[host]['connections']
+    return connection_stats
+
+def print_connection_stats():
+    for host, stats in get_connection_stats().items():
+        reuse_rate = stats['reused'] / stats['requests'] * 100 if stats['requests'] > 0 else 0
+        print(f"{host}: {stats['requests']} requests over {stats['connections']} connections ({reuse_rate:.1f}% reused)")
+
+def get_total_nfts(collection_name, sleep_time=0.4):
+    url = f'https://api.elrond.com/collections/{collection_name}/nfts/count'
+    response = get_with_retries(url, get_user_agent(), sleep_time)
+    if response.status_code == 404:
+        return None
+    return response.json()
+
+def get_collection_info(collection_name, sleep_time=0.4):
+    url = f'https://api.elrond.com/collections/{collection_name}'
+    response = get_with_retries(url, get_user_agent(), sleep_time)
+    if response.status_code == 404:
+        return None
+    collection_info = response.json()
     collection_info['totalNfts'] = get_total_nfts(collection_name)
     return collection_info
 
 def get_nft(identifier, sleep_time=0.4):
-    user_agent = UserAgent()
-    while True:
-        try:
-            url = f'https://api.elrond.com/nfts/{identifier}'
-            headers = {'User-Agent': user_agent.random}
-            response = requests.get(url, headers=headers)
-            if response.status_code == 200:
-                nft = response.json()
-                break
-            elif response.status_code == 404:
-                return None
-            else:
-                time.sleep(sleep_time)
-        except:
-            time.sleep(sleep_time)
-    return nft
+    url = f'https://api.elrond.com/nfts/{identifier}'
+    response = get_with_retries(url, get_user_agent(), sleep_time)
+    if response.status_code == 404:
+        return None
+    return response.json()
 
 def get_collection_nfts(collection_name, sleep_time=0.4):
     collection_info = get_collection_info(collection_name)
     if collection_info is None:
         return None
-    user_agent = UserAgent()
+    user_agent = get_user_agent()
     length = 0
-    collection_nfts = {}
+    collection_nfts = CollectionNfts()
     bar = tqdm(total=collection_info['totalNfts'], desc=f"get_collection_nfts('{collection_name}')", position=0)
     for order in ['asc', 'desc']:
         start = 0
         stop = 10000
         step = 100
         for index in range(start, stop, step):
-            while True:
-                try:
-                    url = f'https://api.elrond.com/collections/{collection_name}/nfts?from={index}&size={step}&withOwner=true&sort=nonce&order={order}'
-                    headers = {'User-Agent': user_agent.random}
-                    response = requests.get(url, headers=headers)
-                    if response.status_code == 200:
-                        for nft in response.json():
-                            if 'owner' not in nft:
-                                nft = get_nft(nft['identifier'], sleep_time)
-                            collection_nfts[nft['identifier']] = nft
-                        new_length = len(collection_nfts)
-                        bar.update(new_length - length)
-                        if new_length == length:
-                            collection_nfts = clear_keys(collection_nfts)
-                            collection_nfts = dict(sorted(collection_nfts.items()))
-                            return collection_nfts
-                        length = new_length
-                        break
-                    if response.status_code == 429:
-                        time.sleep(sleep_time)
-                except:
-                    time.sleep(sleep_time*100)
-    collection_nfts = clear_keys(collection_nfts)
-    collection_nfts = dict(sorted(collection_nfts.items()))
+            url = f'https://api.elrond.com/collections/{collection_name}/nfts?from={index}&size={step}&withOwner=true&sort=nonce&order={order}'
+            response = get_with_retries(url, user_agent, sleep_time, accept=(200,))
+            for nft in response.json():
+                if 'owner' not in nft:
+                    nft = get_nft(nft['identifier'], sleep_time)
+                collection_nfts.add(nft)
+            new_length = len(collection_nfts)
+            bar.update(new_length - length)
+            if new_length == length:
+                return collection_nfts
+            length = new_length
+    return collection_nfts
+
+default_max_concurrency = 8
+max_concurrency = {
+    'api.elrond.com': 8,
+    'metadata.cantinaroyale.io': 8,
+    'metadata.verko.io': 8,
+    'api.xoxno.com': 4
+}
+
+def get_semaphores():
+    return defaultdict(lambda: asyncio.Semaphore(default_max_concurrency), {host: asyncio.Semaphore(limit) for host, limit in max_concurrency.items()})
+
+def run_async(coroutine):
+    async def main():
+        max_workers = sum(max_concurrency.values()) + default_max_concurrency
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=max_workers))
+        return await coroutine
+    return asyncio.run(main())
+
+async def async_get_json(url, semaphores, user_agent, sleep_time=0.4):
+    async with semaphores[get_host(url)]:
+        response = await async_get_with_retries(url, user_agent, sleep_time)
+        if response.status_code == 404:
+            return None
+        return response.json()
+
+async def async_get_nfts(identifiers, semaphores, user_agent, sleep_time=0.4):
+    urls = [f'https://api.elrond.com/nfts/{identifier}' for identifier in identifiers]
+    nfts = await asyncio.gather(*[async_get_json(url, semaphores, user_agent, sleep_time) for url in urls])
+    return {identifier: nft for identifier, nft in zip(identifiers, nfts) if nft is not None}
+
+async def async_get_top_nonce(collection_name, semaphores, user_agent, sleep_time=0.4):
+    url = f'https://api.elrond.com/collections/{collection_name}/nfts?from=0&size=1&sort=nonce&order=desc'
+    page = await async_get_json(url, semaphores, user_agent, sleep_time)
+    return page[0]['nonce'] if page else 0
+
+async def async_get_nfts_batched(identifiers, semaphores, user_agent, sleep_time=0.4, batch_size=50):
+    urls = []
+    for index in range(0, len(identifiers), batch_size):
+        batch = identifiers[index:index+batch_size]
+        urls.append(f'https://api.elrond.com/nfts?identifiers={",".join(batch)}&size={len(batch)}&withOwner=true')
+    pages = await asyncio.gather(*[async_get_json(url, semaphores, user_agent, sleep_time) for url in urls])
+    return {nft['identifier']: nft for page in pages for nft in page or []}
+
+async def async_backfill_owners(identifiers, semaphores, user_agent, sleep_time=0.4):
+    nfts = {identifier: nft for identifier, nft in (await async_get_nfts_batched(identifiers, semaphores, user_agent, sleep_time)).items() if 'owner' in nft}
+    missing = [identifier for identifier in identifiers if identifier not in nfts]
+    nfts.update(await async_get_nfts(missing, semaphores, user_agent, sleep_time))
+    return nfts
+
+async def async_get_collection_nfts(collection_name, sleep_time=0.4):
+    user_agent = get_user_agent()
+    semaphores = get_semaphores()
+    url = f'https://api.elrond.com/collections/{collection_name}'
+    collection_info = await async_get_json(url, semaphores, user_agent, sleep_time)
+    if collection_info is None:
+        return None
+    url = f'https://api.elrond.com/collections/{collection_name}/nfts/count'
+    total_nfts = await async_get_json(url, semaphores, user_agent, sleep_time)
+    top_nonce = await async_get_top_nonce(collection_name, semaphores, user_agent, sleep_time)
+    # one page per nonce range, so no listing ever reaches the api's 10000 items window. the api
+    # filters with nonce >= nonceAfter and nonce <= nonceBefore; the windows still overlap by one
+    # nonce on each side so that no gap opens should the bounds be exclusive, duplicates collapse
+    # on the identifier and the count is checked against total_nfts below
+    step = 100
+    urls = []
+    for nonce in range(1, top_nonce + 1, step):
+        urls.append(f'https://api.elrond.com/collections/{collection_name}/nfts?from=0&size={step + 2}&withOwner=true&nonceAfter={nonce - 1}&nonceBefore={nonce + step}')
+    bar = tqdm(total=total_nfts, desc=f"get_collection_nfts_async('{collection_name}')", position=0)
+    collection_nfts = CollectionNfts()
+    missing_owner = set()
+
+    def add_nfts(nfts):
+        length = len(collection_nfts) + len(missing_owner)
+        for nft in nfts:
+            # added once backfilled, an nft without owner would drop the key for the whole collection
+            if 'owner' in nft:
+                missing_owner.discard(nft['identifier'])
+                collection_nfts.add(nft)
+            elif nft['identifier'] not in collection_nfts:
+                missing_owner.add(nft['identifier'])
+        bar.update(len(collection_nfts) + len(missing_owner) - length)
+
+    for page in asyncio.as_completed([async_get_json(url, semaphores, user_agent, sleep_time) for url in urls]):
+        add_nfts(await page or [])
+    # nonces that no window returned are looked up by identifier
+    if len(collection_nfts) + len(missing_owner) < total_nfts:
+        seen = set(collection_nfts) | missing_owner
+        missing = [identifier for identifier in (get_identifier(collection_name, nonce) for nonce in range(1, top_nonce + 1)) if identifier not in seen]
+        print(f'{collection_name}: {len(seen)} of {total_nfts} nfts listed by nonce range, backfilling {len(missing)} nonces')
+        add_nfts((await async_get_nfts_batched(missing, semaphores, user_agent, sleep_time)).values())
+    collection_nfts.extend((await async_backfill_owners(sorted(missing_owner), semaphores, user_agent, sleep_time)).values())
+    if len(collection_nfts) != total_nfts:
+        print(f'{collection_name}: {len(collection_nfts)} nfts fetched, the api counts {total_nfts}')
+    bar.close()
     return collection_nfts
 
+def get_collection_nfts_async(collection_name, sleep_time=0.4):
+    return run_async(async_get_collection_nfts(collection_name, sleep_time))
+
+def get_identifier(collection_name, nonce):
+    hex_index = hex(nonce)[2:]
+    if len(hex_index) % 2 == 1:
+        hex_index = f'0{hex_index}'
+    return f'{collection_name}-{hex_index}'
+
 def get_collection_nfts_worker(args):
     start, stop, collection_name, sleep_time = args
     sub_collection_nfts = {}
     for index in range(start, stop):
-        if len(hex(index)) % 2 == 1:
-            hex_index = f'0{hex(index)[2:]}'
-        else:
-            hex_index = hex(index)[2:]
-        identifier = f'{collection_name}-{hex_index}'
+        identifier = get_identifier(collection_name, index)
         nft = get_nft(identifier, sleep_time)
         if nft is not None:
             sub_collection_nfts[identifier] = nft
     return sub_collection_nfts
 
+def get_top_nonce(collection_name, sleep_time=0.4):
+    url = f'https://api.elrond.com/collections/{collection_name}/nfts?from=0&size=1&sort=nonce&order=desc'
+    response = get_with_retries(url, get_user_agent(), sleep_time, accept=(200,))
+    page = response.json()
+    return page[0]['nonce'] if page else 0
+
+def estimate_top_nonce(collection_name, total_nfts, sleep_time=0.4):
+    # fallback for when the sorted listing is unavailable; it assumes contiguous nonces, a burnt
+    # nft can make it stop short, which the probing in get_collection_nfts_master makes up for
+    lo = 0
+    hi = max(total_nfts, 1)
+    while get_nft(get_identifier(collection_name, hi), sleep_time) is not None:
+        lo = hi
+        hi *= 2
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if get_nft(get_identifier(collection_name, mid), sleep_time) is not None:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
 def get_collection_nfts_master(collection_name, sleep_time=0.4, core=4):
     collection_info = get_collection_info(collection_name)
     if collection_info is None:
         return None
+    try:
+        top_nonce = get_top_nonce(collection_name, sleep_time)
+    except FetchError:
+        top_nonce = estimate_top_nonce(collection_name, collection_info['totalNfts'], sleep_time)
     bar = tqdm(total=collection_info['totalNfts'], desc=f"get_collection_nfts('{collection_name}')", position=0)
-    collection_nfts = {}
-    start = 0
-    stop = collection_info['totalNfts']
+    collection_nfts = CollectionNfts()
+    start = 1
+    stop = top_nonce + 1
     step = 20
-    while len(collection_nfts) != collection_info['totalNfts']:
-        chunks = [(i, min(i+step, stop), collection_name, sleep_time) for i in range(start, stop, step)]
-        with Pool(core) as p:
-            for sub_collection_nfts in p.imap(get_collection_nfts_worker, chunks):
-                collection_nfts.update(sub_collection_nfts)
+    with ThreadPoolExecutor(core) as executor:
+        while len(collection_nfts) < collection_info['totalNfts']:
+            futures = [executor.submit(contextvars.copy_context().run, get_collection_nfts_worker, (i, min(i+step, stop), collection_name, sleep_time)) for i in range(start, stop, step)]
+            length = len(collection_nfts)
+            for future in as_completed(futures):
+                sub_collection_nfts = future.result()
+                collection_nfts.extend(sub_collection_nfts.values())
                 bar.update(len(sub_collection_nfts))
                 if len(collection_nfts) == collection_info['totalNfts']:
+                    for future in futures:
+                        future.cancel()
                     break
-        new_stop = stop + max(step*core, stop//2)
-        start = stop
-        stop = new_stop
+            # nfts the api counts are still missing: probe further windows, until one past the
+            # top nonce turns up nothing
+            if len(collection_nfts) == length and start > top_nonce:
+                break
+            start = stop
+            stop = stop + step*core
     bar.close()
-    collection_nfts = clear_keys(collection_nfts)
-    collection_nfts = dict(sorted(collection_nfts.items()))
     return collection_nfts
 
 def get_collection_nfts_slow(collection_name, sleep_time=0.4, core=1):
@@ -168,23 +869,19 @@ def get_collection_nfts_slow(collection_name, sleep_time=0.4, core=1):
     if collection_info is None:
         return None
     bar = tqdm(total=collection_info['totalNfts'], desc=f"get_collection_nfts('{collection_name}')", position=0)
-    collection_nfts = {}
+    collection_nfts = CollectionNfts()
     for index in range(0, collection_info['totalNfts']):
-        if len(hex(index)) % 2 == 1:
-            hex_index = f'0{hex(index)[2:]}'
-        else:
-            hex_index = hex(index)[2:]
-        identifier = f'{collection_name}-{hex_index}'
+        identifier = get_identifier(collection_name, index)
         nft = get_nft(identifier, sleep_time)
         if nft is not None:
-            collection_nfts[identifier] = nft
+            collection_nfts.add(nft)
             bar.update(1)
     bar.close()
-    collection_nfts = clear_keys(collection_nfts)
-    collection_nfts = dict(sorted(collection_nfts.items()))
     return collection_nfts
 
 def open_stealth_driver(headless=False, maximize=True, options=None):
+    from selenium import webdriver
+    from selenium_stealth import stealth
     if options is None:
         options = webdriver.ChromeOptions()
         if maximize:
@@ -204,160 +901,980 @@ def open_stealth_driver(headless=False, maximize=True, options=None):
             )
     return driver
 
-def get_collection_offchain_data(collection_nfts, sleep_time=0.4, whitelist=None, blacklist=['https://ipfs.io/ipfs/', 'https://gateway.pinata.cloud/ipfs/']):
-    xoxno_address = 'erd1qqqqqqqqqqqqqpgq6wegs2xkypfpync8mn2sa5cmpqjlvrhwz5nqgepyg8'
-    user_agent = UserAgent()
+xoxno_address = 'erd1qqqqqqqqqqqqqpgq6wegs2xkypfpync8mn2sa5cmpqjlvrhwz5nqgepyg8'
+
+def get_offchain_urls(nft, whitelist=None, blacklist=['https://ipfs.io/ipfs/', 'https://gateway.pinata.cloud/ipfs/']):
+    urls = {}
+    for uri in nft['uris']:
+        url = base64.b64decode(uri).decode('utf-8')
+        if blacklist is not None and any([url.startswith(b) for b in blacklist]):
+            urls[url] = False
+        elif whitelist is not None and not any([url.startswith(w) for w in whitelist]):
+            urls[url] = False
+        else:
+            urls[url] = True
+    return urls
+
+def get_offchain_document(url, user_agent, sleep_time=0.4):
+    response = get_with_retries(url, user_agent, sleep_time)
+    if response.status_code == 404:
+        raise FetchError(f'{url}: not found')
+    try:
+        return response.json()
+    except ValueError:
+        raise FetchError(f'{url}: not a json document')
+
+def get_listing_price(listing):
+    try:
+        price = {
+            'currency': listing['saleInfo']['paymentToken'],
+            'amount': float(listing['saleInfo']['minBidShort'])
+        }
+    except:
+        price = {
+            'currency': None,
+            'amount': None
+        }
+    return price
+
+def get_nft_price(identifier, user_agent, sleep_time=0.4):
+    url = f'https://api.xoxno.com/nft/{identifier}'
+    response = get_with_retries(url, user_agent, sleep_time, accept=(200,))
+    try:
+        listing = response.json()
+    except ValueError:
+        listing = None
+    return get_listing_price(listing)
+
+# active listings of a collection, a page of listings_page_size at a time; every listing carries
+# its identifier and the same saleInfo as the per-nft endpoint. the endpoint and its page shape
+# ({'resources': [...], 'hasMoreResults': ...}) are assumed, not documented, so pages are checked
+xoxno_listings_url = 'https://api.xoxno.com/collection/{collection}/listings?skip={skip}&top={top}'
+listings_page_size = 100
+# well past the size of any collection, an endpoint ignoring skip cannot page forever
+listings_max_skip = 100000
+
+def get_collection_listings(collection_name, sleep_time=0.4, page_size=None):
+    # identifier -> price of every listed nft, pages are read until the api says there are no more
+    # or a page adds no identifier that was not seen yet
+    page_size = page_size or listings_page_size
+    user_agent = get_user_agent()
+    listings = {}
+    skip = 0
+    while True:
+        url = xoxno_listings_url.format(collection=collection_name, skip=skip, top=page_size)
+        try:
+            page = get_with_retries(url, user_agent, sleep_time, accept=(200,)).json()
+        except ValueError:
+            raise FetchError(f'{url}: not a json document')
+        if not isinstance(page, dict) or not isinstance(page.get('resources'), list) or not all([isinstance(listing, dict) and 'identifier' in listing for listing in page['resources']]):
+            raise FetchError(f'{url}: unexpected listings page, expected resources with identifiers')
+        length = len(listings)
+        for listing in page['resources']:
+            listings[listing['identifier']] = get_listing_price(listing)
+        if not page.get('hasMoreResults') or len(listings) == length:
+            return listings
+        skip += page_size
+        if skip > listings_max_skip:
+            raise FetchError(f'{url}: still more listings past skip={listings_max_skip}')
+
+def get_offchain_value(identifier, key, user_agent, sleep_time=0.4):
+    if key == 'price':
+        return get_nft_price(identifier, user_agent, sleep_time)
+    return get_offchain_document(key, user_agent, sleep_time)
+
+def get_offchain_fallback(key, previous=None):
+    # what a job the retry policy gave up on publishes: the previous run's value when there is one,
+    # else no price for a price, and None for a document, see withhold_offchain_data
+    if previous is not None and previous['offchainData'].get(key) is not None:
+        return previous['offchainData'][key]
+    if key == 'price':
+        return {
+            'currency': None,
+            'amount': None
+        }
+    return None
+
+def withhold_offchain_data(identifier, sync_state=None):
+    # a document with nothing to fall back on would be published as empty attributes (a weapon
+    # without starLevel drops out of the market data); the nft is left out of this run instead and
+    # fetched from scratch by the next one
+    record_stale()
+    if sync_state is not None:
+        sync_state.pop(identifier, None)
+
+def mark_offchain_stale(identifier, offchain_data, sync_state=None):
+    # published with fallbacks in place; a cleared fingerprint makes the next run fetch it all again
+    offchain_data['stale'] = True
+    record_stale()
+    if sync_state is not None and identifier in sync_state:
+        sync_state[identifier] = {**sync_state[identifier], 'fingerprint': None, 'offchainData': {key: value for key, value in offchain_data.items() if key != 'stale'}}
+
+def get_collection_offchain_data(collection_nfts, sleep_time=0.4, whitelist=None, blacklist=['https://ipfs.io/ipfs/', 'https://gateway.pinata.cloud/ipfs/'], journal_filename=None, journal_max_age=24*3600, fetch_prices=True):
+    user_agent = get_user_agent()
     collection_offchain_data = {}
     if len(collection_nfts) == 0:
         return collection_offchain_data
     collection_name = '-'.join(list(collection_nfts.keys())[0].split('-')[:-1])
     bar = tqdm(total=len(collection_nfts), desc=f"get_collection_offchain_data('{collection_name}')", position=0)
-    for identifier in collection_nfts:
-        while True:
-            try:
-                offchain_data = {}
-                for uri in collection_nfts[identifier]['uris']:
-                    url = base64.b64decode(uri).decode('utf-8')
-                    if blacklist is not None and any([url.startswith(b) for b in blacklist]):
-                        offchain_data[url] = None
-                    elif whitelist is not None and not any([url.startswith(w) for w in whitelist]):
-                        offchain_data[url] = None
-                    else:
-                        while True:
-                            time.sleep(sleep_time)
-                            headers = {'User-Agent': user_agent.random}
-                            response = requests.get(url, headers=headers)
-                            if response.status_code == 200:
-                                offchain_data[url] = response.json()
-                                break
-                            else:
-                                time.sleep(sleep_time*100)
-                if collection_nfts[identifier]['owner'] != xoxno_address:
-                    offchain_data['price'] = {
-                        'currency': None,
-                        'amount': None
-                    }
-                else:
-                    url = f'https://api.xoxno.com/nft/{identifier}'
-                    while True:
-                        time.sleep(sleep_time)
-                        headers = {'User-Agent': user_agent.random}
-                        response = requests.get(url, headers=headers)
-                        if response.status_code == 200:
-                            try:
-                                price = response.json()
-                                price = {
-                                    'currency': price['saleInfo']['paymentToken'],
-                                    'amount': float(price['saleInfo']['minBidShort'])
-                                }
-                            except:
-                                price = {
-                                    'currency': None,
-                                    'amount': None
-                                }
-                            offchain_data['price'] = price
-                            break
-                        else:
-                            time.sleep(sleep_time*100)
-                collection_offchain_data[identifier] = offchain_data
+    with open_offchain_journal(journal_filename, collection_nfts, journal_max_age) as (checkpoint, journal):
+        for identifier in collection_nfts:
+            if identifier in checkpoint:
+                collection_offchain_data[identifier] = restore_offchain_data(identifier, checkpoint.pop(identifier))
                 bar.update(1)
-                break
-            except:
-                pass
+                continue
+            offchain_data, jobs, fingerprint, _ = plan_offchain_data(identifier, collection_nfts[identifier], whitelist=whitelist, blacklist=blacklist, fetch_prices=fetch_prices)
+            failed = False
+            withheld = False
+            for key in jobs:
+                try:
+                    offchain_data[key] = get_offchain_value(identifier, key, user_agent, sleep_time)
+                except FetchError:
+                    offchain_data[key] = get_offchain_fallback(key)
+                    failed = True
+                    withheld = withheld or offchain_data[key] is None
+            if withheld:
+                withhold_offchain_data(identifier)
+                bar.update(1)
+                continue
+            if failed:
+                mark_offchain_stale(identifier, offchain_data)
+            if len(jobs) > 0:
+                journal_offchain_data(journal, identifier, fingerprint, offchain_data)
+            collection_offchain_data[identifier] = offchain_data
+            bar.update(1)
     bar.close()
     return collection_offchain_data
 
-def parse_nft_data(nft):
-    # onchain data
-    onchain_data = {}
-    onchain_data['identifier'] = nft.get('identifier', None)
-    onchain_data['collection'] = nft.get('collection', None)
-    onchain_data['name'] = nft.get('name', None)
-    onchain_data['url'] = nft['media'][-1].get('url', None) if nft.get('media', []) != [] else None
-    onchain_data['thumbnailUrl'] = nft['media'][-1].get('thumbnailUrl', None) if nft.get('media', []) != [] else None
-    onchain_data['owner'] = nft.get('owner', None)
-    onchain_data['rank'] = nft.get('rank', None)
-    if nft['metadata'] != {}:
-        for attribute in nft['metadata'].get('attributes', []):
-            onchain_data[attribute['trait_type']] = attribute['value']
-    if onchain_data['collection'] in ['EAPES-8f3c1f']:
-        for attibute in ['Background', 'Type', 'Eyes', 'Mouth', 'Clothes', 'Earring', 'priceCurrency', 'priceAmount', 'Hat', 'Special']:
-            onchain_data[attibute] = 'None'
-    # offchain data
+def get_nft_fingerprint(nft):
+    onchain_content = json.dumps([nft.get('uris'), nft.get('attributes')], sort_keys=True)
+    return {
+        'nonce': nft.get('nonce'),
+        'owner': nft.get('owner'),
+        'hash': hashlib.sha256(onchain_content.encode('utf-8')).hexdigest()
+    }
+
+def is_offchain_stale(identifier, fetched_at, ttl, now):
+    # spread expiries over [ttl/2, ttl] so a full sync does not expire all at once
+    spread = int(hashlib.sha256(identifier.encode('utf-8')).hexdigest()[:8], 16) / 0xffffffff
+    return now - fetched_at > ttl * (0.5 + 0.5 * spread)
+
+def load_sync_state(filename):
+    if not os.path.exists(filename):
+        return {}
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+def save_sync_state(filename, sync_state):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(f'{filename}.tmp', 'w') as f:
+        json.dump(sync_state, f)
+    os.replace(f'{filename}.tmp', filename)
+
+def plan_offchain_data(identifier, nft, previous=None, ttl=None, now=None, whitelist=None, blacklist=['https://ipfs.io/ipfs/', 'https://gateway.pinata.cloud/ipfs/'], fetch_prices=True):
+    fingerprint = get_nft_fingerprint(nft)
+    changed = previous is None or previous['fingerprint'] != fingerprint
+    stale = changed or is_offchain_stale(identifier, previous['fetchedAt'], ttl, now)
     offchain_data = {}
-    offchain_data['priceCurrency'] = nft['offchainData']['price']['currency']
-    offchain_data['priceAmount'] = nft['offchainData']['price']['amount']
-    if onchain_data['collection'] in ['CRMYTH-546419', 'CRWEAPONS-e5ab49']:
-        for url, data in nft['offchainData'].items():
-            if url.startswith('https://metadata.cantinaroyale.io/dynamic/'):
-                if 'error' in data:
-                    for attibute in ['xp', 'wear', 'level', 'starLevel', 'Damage', 'Reload Time', 'Ammo', 'Range']:
-                        offchain_data[attibute] = None
-                else:
-                    for key, value in data.items():
-                        if key == 'stats':
-                            for attribute in value:
-                                offchain_data[attribute['name']] = attribute['value']
-                        else:
-                            offchain_data[key] = value
-    elif onchain_data['collection'] in ['CRCHAMPS-d0265d', 'CRHEROES-9edff2']:
-        for url, data in nft['offchainData'].items():
-            if url.startswith('https://metadata.cantinaroyale.io/metadata/'):
-                if 'error' in data:
-                    for attibute in ['Background', 'Body', 'Earrings', 'Eyes', 'Face', 'Head', 'Headgear', 'LegAccessories', 'Legs', 'Mouth', 'Perk 1', 'Perk 2', 'Rarity Class', 'Skin', 'Species']:
-                        offchain_data[attibute] = None
-                else:
-                    for attribute in data['attributes']:
-                        offchain_data[attribute['trait_type']] = attribute['value']
-            elif url.startswith('https://metadata.cantinaroyale.io/dynamic/'):
-                if 'error' in data:
-                    for attibute in ['level', 'health', 'shield', 'talent_points_available', 'talent_points_total', 'earn_rate', 'character_tokens', 'Overachiever', 'Hodler', 'Grounded', 'Stonewall', 'Adrenaline Rush', 'Overshield', 'Black Widow', 'Galvanized', 'Nano Meds', 'Resilience', 'Cold Blooded', 'Perseverance', 'Escape Artist', 'Scavenger', 'Cool Moves', 'Brawler', 'Automatic Weapons Proficiency', 'Scatter Weapons Proficiency', 'Precision Weapons Proficiency', 'Explosive Weapons Proficiency', 'Elemental Weapons Proficiency']:
-                        offchain_data[attibute] = None
+    jobs = []
+    for url, fetch in get_offchain_urls(nft, whitelist, blacklist).items():
+        if not fetch:
+            offchain_data[url] = None
+        elif changed or url not in previous['offchainData'] or (stale and not any([url.startswith(p) for p in static_offchain_prefixes])):
+            offchain_data[url] = None
+            jobs.append(url)
+        else:
+            offchain_data[url] = previous['offchainData'][url]
+    # without fetch_prices the price is left empty for the listings stage to fill in
+    if nft.get('owner') != xoxno_address or not fetch_prices:
+        offchain_data['price'] = {
+            'currency': None,
+            'amount': None
+        }
+    else:
+        offchain_data['price'] = None
+        jobs.append('price')
+    return offchain_data, jobs, fingerprint, stale
+
+def update_sync_state(sync_state, identifier, offchain_data, fingerprint, stale, now):
+    sync_state[identifier] = {
+        'fingerprint': fingerprint,
+        'fetchedAt': now if stale else sync_state[identifier]['fetchedAt'],
+        'offchainData': offchain_data
+    }
+
+def prune_sync_state(sync_state, collection_nfts):
+    for identifier in list(sync_state.keys()):
+        if identifier not in collection_nfts:
+            del sync_state[identifier]
+
+@contextmanager
+def open_offchain_journal(filename, collection_nfts, max_age):
+    # yields the records an interrupted attempt at the stage left behind that can stand in for a
+    # fetch (not stale, at most max_age seconds old, same onchain fingerprint), after compacting
+    # the journal to just those, and the journal opened to append the ones fetched now
+    if filename is None:
+        yield {}, None
+        return
+    checkpoint = {}
+    now = time.time()
+    for record in read_jsonl(filename):
+        nft = collection_nfts.get(record['identifier'])
+        if nft is not None and not record['offchainData'].get('stale') and now - record['journaledAt'] <= max_age and record['fingerprint'] == get_nft_fingerprint(nft):
+            checkpoint[record['identifier']] = record
+    write_jsonl(filename, checkpoint.values())
+    with open_journal(filename) as journal:
+        yield checkpoint, journal
+
+def restore_offchain_data(identifier, record, sync_state=None):
+    if sync_state is not None:
+        sync_state[identifier] = {
+            'fingerprint': record['fingerprint'],
+            'fetchedAt': record['fetchedAt'],
+            'offchainData': record['offchainData']
+        }
+    return record['offchainData']
+
+def journal_offchain_data(journal, identifier, fingerprint, offchain_data, sync_state=None):
+    if journal is None:
+        return
+    append_journal(journal, {
+        'identifier': identifier,
+        'journaledAt': time.time(),
+        'fingerprint': fingerprint,
+        'fetchedAt': sync_state[identifier]['fetchedAt'] if sync_state is not None else time.time(),
+        'offchainData': offchain_data
+    })
+
+def get_collection_offchain_data_incremental(collection_nfts, sync_state, ttl=7*24*3600, sleep_time=0.4, whitelist=None, blacklist=['https://ipfs.io/ipfs/', 'https://gateway.pinata.cloud/ipfs/'], journal_filename=None, journal_max_age=24*3600, fetch_prices=True):
+    user_agent = get_user_agent()
+    collection_offchain_data = {}
+    if len(collection_nfts) == 0:
+        return collection_offchain_data
+    collection_name = '-'.join(list(collection_nfts.keys())[0].split('-')[:-1])
+    bar = tqdm(total=len(collection_nfts), desc=f"get_collection_offchain_data_incremental('{collection_name}')", position=0)
+    requests_count = 0
+    with open_offchain_journal(journal_filename, collection_nfts, journal_max_age) as (checkpoint, journal):
+        for identifier in collection_nfts:
+            if identifier in checkpoint:
+                collection_offchain_data[identifier] = restore_offchain_data(identifier, checkpoint.pop(identifier), sync_state)
+                bar.update(1)
+                continue
+            now = time.time()
+            previous = sync_state.get(identifier)
+            offchain_data, jobs, fingerprint, stale = plan_offchain_data(identifier, collection_nfts[identifier], previous, ttl, now, whitelist, blacklist, fetch_prices)
+            failed = False
+            withheld = False
+            for key in jobs:
+                try:
+                    offchain_data[key] = get_offchain_value(identifier, key, user_agent, sleep_time)
+                except FetchError:
+                    offchain_data[key] = get_offchain_fallback(key, previous)
+                    failed = True
+                    withheld = withheld or offchain_data[key] is None
+            requests_count += len(jobs)
+            if withheld:
+                withhold_offchain_data(identifier, sync_state)
+                bar.update(1)
+                continue
+            update_sync_state(sync_state, identifier, offchain_data, fingerprint, stale, now)
+            if failed:
+                mark_offchain_stale(identifier, offchain_data, sync_state)
+            if len(jobs) > 0:
+                journal_offchain_data(journal, identifier, fingerprint, offchain_data, sync_state)
+            collection_offchain_data[identifier] = offchain_data
+            bar.update(1)
+            bar.set_postfix(requests=requests_count)
+    bar.close()
+    prune_sync_state(sync_state, collection_nfts)
+    return collection_offchain_data
+
+async def async_get_collection_offchain_data(collection_nfts, sync_state=None, ttl=7*24*3600, sleep_time=0.4, whitelist=None, blacklist=['https://ipfs.io/ipfs/', 'https://gateway.pinata.cloud/ipfs/'], emit=None, journal_filename=None, journal_max_age=24*3600, fetch_prices=True, stop=None, chunk_size=1000):
+    # identifiers are planned and fetched chunk_size at a time; once stop is set no further
+    # request starts, the journal keeps what was done and the sync state is left unpruned
+    user_agent = get_user_agent()
+    semaphores = get_semaphores()
+    collection_offchain_data = {}
+    if len(collection_nfts) == 0:
+        return collection_offchain_data
+    collection_name = '-'.join(list(collection_nfts.keys())[0].split('-')[:-1])
+    bar = tqdm(total=len(collection_nfts), desc=f"get_collection_offchain_data_async('{collection_name}')", position=0)
+    pending = {}
+    previous = {}
+    fingerprints = {}
+    failed = set()
+    withheld = set()
+
+    async def fetch(identifier, key):
+        try:
+            async with semaphores[get_host('https://api.xoxno.com/' if key == 'price' else key)]:
+                if stop is not None and stop.is_set():
+                    return
+                value = await asyncio.to_thread(get_offchain_value, identifier, key, user_agent, sleep_time)
+        except FetchError:
+            value = get_offchain_fallback(key, previous.get(identifier))
+            failed.add(identifier)
+            if value is None:
+                withheld.add(identifier)
+        collection_offchain_data[identifier][key] = value
+        pending[identifier] -= 1
+        if pending[identifier] == 0:
+            if identifier in withheld:
+                withhold_offchain_data(identifier, sync_state)
+                del collection_offchain_data[identifier]
+            else:
+                if identifier in failed:
+                    mark_offchain_stale(identifier, collection_offchain_data[identifier], sync_state)
+                journal_offchain_data(journal, identifier, fingerprints[identifier], collection_offchain_data[identifier], sync_state)
+            complete(identifier)
+
+    def complete(identifier):
+        previous.pop(identifier, None)
+        fingerprints.pop(identifier, None)
+        # with emit, finished documents are handed over instead of held until the end, a withheld
+        # one as None
+        if emit is not None:
+            emit(identifier, collection_offchain_data.pop(identifier, None))
+        bar.update(1)
+
+    now = time.time()
+    requests_count = 0
+    identifiers = iter(collection_nfts)
+    with open_offchain_journal(journal_filename, collection_nfts, journal_max_age) as (checkpoint, journal):
+        while stop is None or not stop.is_set():
+            chunk = list(islice(identifiers, chunk_size))
+            if len(chunk) == 0:
+                break
+            work_queue = []
+            for identifier in chunk:
+                if identifier in checkpoint:
+                    collection_offchain_data[identifier] = restore_offchain_data(identifier, checkpoint.pop(identifier), sync_state)
+                    complete(identifier)
+                    continue
+                previous[identifier] = sync_state.get(identifier) if sync_state is not None else None
+                offchain_data, jobs, fingerprints[identifier], stale = plan_offchain_data(identifier, collection_nfts[identifier], previous[identifier], ttl, now, whitelist, blacklist, fetch_prices)
+                collection_offchain_data[identifier] = offchain_data
+                if sync_state is not None:
+                    update_sync_state(sync_state, identifier, offchain_data, fingerprints[identifier], stale, now)
+                pending[identifier] = len(jobs)
+                if len(jobs) == 0:
+                    complete(identifier)
+                work_queue += [(identifier, key) for key in jobs]
+            requests_count += len(work_queue)
+            bar.set_postfix(requests=requests_count)
+            await asyncio.gather(*[fetch(identifier, key) for identifier, key in work_queue])
+    bar.close()
+    if sync_state is not None and (stop is None or not stop.is_set()):
+        prune_sync_state(sync_state, collection_nfts)
+    return collection_offchain_data
+
+def get_collection_offchain_data_async(collection_nfts, sync_state=None, ttl=7*24*3600, sleep_time=0.4, whitelist=None, blacklist=['https://ipfs.io/ipfs/', 'https://gateway.pinata.cloud/ipfs/'], journal_filename=None, journal_max_age=24*3600, fetch_prices=True):
+    return run_async(async_get_collection_offchain_data(collection_nfts, sync_state, ttl, sleep_time, whitelist, blacklist, journal_filename=journal_filename, journal_max_age=journal_max_age, fetch_prices=fetch_prices))
+
+def iter_collection_offchain_data_async(collection_nfts, sync_state=None, ttl=7*24*3600, sleep_time=0.4, whitelist=None, blacklist=['https://ipfs.io/ipfs/', 'https://gateway.pinata.cloud/ipfs/'], journal_filename=None, journal_max_age=24*3600, fetch_prices=True):
+    # the event loop runs in a background thread, results are yielded in collection order
+    # as soon as every earlier identifier is done, so only the out-of-order window is buffered;
+    # a consumer that stops early (an error, or the generator closed) stops the fetching too
+    completed = queue.Queue()
+    stop = threading.Event()
+
+    def run():
+        try:
+            run_async(async_get_collection_offchain_data(collection_nfts, sync_state, ttl, sleep_time, whitelist, blacklist, emit=lambda identifier, offchain_data: completed.put((identifier, offchain_data)), journal_filename=journal_filename, journal_max_age=journal_max_age, fetch_prices=fetch_prices, stop=stop))
+            completed.put(None)
+        except BaseException as e:
+            completed.put(e)
+
+    threading.Thread(target=contextvars.copy_context().run, args=(run,), daemon=True).start()
+    try:
+        done = {}
+        for identifier in list(collection_nfts):
+            while identifier not in done:
+                item = completed.get()
+                if isinstance(item, BaseException):
+                    raise item
+                done[item[0]] = item[1]
+            offchain_data = done.pop(identifier)
+            if offchain_data is not None:
+                yield identifier, offchain_data
+        # wait for the sync state to be pruned before the caller saves it
+        item = completed.get()
+        if isinstance(item, BaseException):
+            raise item
+    finally:
+        stop.set()
+
+def read_jsonl(filename):
+    if not os.path.exists(filename):
+        return
+    with open(filename, 'r') as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # a line cut short by a crash
+                continue
+
+def open_journal(filename):
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    if os.path.exists(filename) and os.path.getsize(filename) > 0:
+        with open(filename, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            complete = f.read(1) == b'\n'
+        if not complete:
+            with open(filename, 'a') as f:
+                f.write('\n')
+    return open(filename, 'a')
+
+def append_journal(journal, record):
+    journal.write(json.dumps(record) + '\n')
+    journal.flush()
+
+def write_jsonl(filename, records):
+    # written under a temporary name so a crash never leaves a truncated stage behind
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    with open(f'{filename}.tmp', 'w') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+    os.replace(f'{filename}.tmp', filename)
+
+def index_jsonl(filename, key):
+    # byte offset of every record, so records can be read back one at a time in any order
+    offsets = {}
+    with open(filename, 'rb') as f:
+        offset = 0
+        for line in f:
+            try:
+                offsets[json.loads(line)[key]] = offset
+            except ValueError:
+                pass
+            offset += len(line)
+    return offsets
+
+def read_jsonl_at(filename, offsets, keys):
+    with open(filename, 'rb') as f:
+        for key in keys:
+            f.seek(offsets[key])
+            yield json.loads(f.readline())
+
+def write_json_object(filename, items, separators=(',', ': ')):
+    # streams {key: value, ...} formatted like json.dump(..., indent=4)
+    with open(f'{filename}.tmp', 'w') as f:
+        f.write('{')
+        first = True
+        for key, value in items:
+            f.write('\n' if first else ',\n')
+            f.write(f'    {json.dumps(key)}{separators[1]}' + json.dumps(value, indent=4, separators=separators).replace('\n', '\n    '))
+            first = False
+        f.write('\n}' if not first else '}')
+    replace_if_changed(f'{filename}.tmp', filename)
+
+def replace_if_changed(tmp_filename, filename):
+    # a file whose content did not change is left untouched, so exports rewrite only what moved
+    if os.path.exists(filename) and filecmp.cmp(tmp_filename, filename, shallow=False):
+        os.remove(tmp_filename)
+    else:
+        os.replace(tmp_filename, filename)
+
+def replace_folder(tmp_folder_path, folder_path):
+    # moves the files of tmp_folder_path over folder_path with replace_if_changed and removes the
+    # ones it no longer has
+    tmp_filenames = set()
+    for root, _, names in os.walk(tmp_folder_path):
+        os.makedirs(os.path.join(folder_path, os.path.relpath(root, tmp_folder_path)), exist_ok=True)
+        for name in names:
+            filename = os.path.relpath(os.path.join(root, name), tmp_folder_path)
+            tmp_filenames.add(filename)
+            replace_if_changed(os.path.join(tmp_folder_path, filename), os.path.join(folder_path, filename))
+    for root, _, names in os.walk(folder_path, topdown=False):
+        for name in names:
+            if os.path.relpath(os.path.join(root, name), folder_path) not in tmp_filenames:
+                os.remove(os.path.join(root, name))
+        if root != folder_path and len(os.listdir(root)) == 0:
+            os.rmdir(root)
+    shutil.rmtree(tmp_folder_path)
+
+def get_stage_filename(folder_path, collection_name, stage, extension='jsonl'):
+    return os.path.join(folder_path, f'{collection_name}.{stage}.{extension}')
+
+def write_parquet(filename, records, batch_size=1000):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    # records are converted a batch at a time, the columns of a batch are the union of the keys
+    # of its records (a key missing from a record is null) and batches are promoted to a
+    # common schema (missing column or null -> any type, int -> float)
+
+    def to_table(batch):
+        keys = dict.fromkeys(key for record in batch for key in record)
+        return pa.Table.from_pydict({key: [record.get(key) for record in batch] for key in keys})
+
+    tables = []
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == batch_size:
+            tables.append(to_table(batch))
+            batch = []
+    if len(batch) > 0:
+        tables.append(to_table(batch))
+    table = pa.concat_tables(tables, promote_options='permissive') if len(tables) > 0 else pa.table({'identifier': pa.array([], pa.string())})
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    pq.write_table(table, f'{filename}.tmp', compression='zstd')
+    os.replace(f'{filename}.tmp', filename)
+
+def read_parquet_columns(filename, columns):
+    import pandas as pd
+    import pyarrow.parquet as pq
+    # columns a collection does not have come back empty instead of failing the read
+    names = pq.read_schema(filename).names
+    return pd.read_parquet(filename, columns=[column for column in columns if column in names]).reindex(columns=columns)
+
+def get_collection_identifiers(folder_path, collection_name):
+    import pyarrow.parquet as pq
+    return pq.read_table(get_stage_filename(folder_path, collection_name, 'nfts', 'parquet'), columns=['identifier']).column('identifier').to_pylist()
+
+def write_collection_listings(folder_path, collection_name, listings):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    # the listings replace the price columns of the working store, an nft without one has no price
+    filename = get_stage_filename(folder_path, collection_name, 'nfts', 'parquet')
+    table = pq.read_table(filename)
+    prices = [listings.get(identifier) or {'currency': None, 'amount': None} for identifier in table.column('identifier').to_pylist()]
+    columns = {
+        'priceCurrency': pa.array([price['currency'] for price in prices], pa.string()),
+        'priceAmount': pa.array([price['amount'] for price in prices], pa.float64())
+    }
+    for name, column in columns.items():
+        if name in table.column_names:
+            table = table.set_column(table.column_names.index(name), name, column)
+        else:
+            table = table.append_column(name, column)
+    pq.write_table(table, f'{filename}.tmp', compression='zstd')
+    os.replace(f'{filename}.tmp', filename)
+
+def read_collection_prices(folder_path, collection_name):
+    # identifier -> price columns of the working store, what a rebuilt store starts from when its
+    # prices are left to the listings stage
+    prices = read_parquet_columns(get_stage_filename(folder_path, collection_name, 'nfts', 'parquet'), ['identifier', 'priceCurrency', 'priceAmount'])
+    prices = prices.astype(object).where(prices.notna(), None)
+    return {price['identifier']: {'priceCurrency': price['priceCurrency'], 'priceAmount': price['priceAmount']} for price in prices.to_dict('records')}
+
+def read_export_table(folder_path, collection_name):
+    import pyarrow.parquet as pq
+    # the working store and, when the market stage has run, in its order and with its
+    # columns replacing or extending the stored ones
+    table = pq.read_table(get_stage_filename(folder_path, collection_name, 'nfts', 'parquet'))
+    market_filename = get_stage_filename(folder_path, collection_name, 'market', 'parquet')
+    if os.path.exists(market_filename):
+        market = pq.read_table(market_filename)
+        rows = {identifier: row for row, identifier in enumerate(table.column('identifier').to_pylist())}
+        table = table.take([rows[identifier] for identifier in market.column('identifier').to_pylist()])
+        for name in market.column_names:
+            if name in table.column_names:
+                table = table.set_column(table.column_names.index(name), name, market.column(name))
+            else:
+                table = table.append_column(name, market.column(name))
+    return table
+
+def export_collection_nfts(folder_path, collection_name, filename, batch_size=1000):
+    # the website json is produced only here
+    table = read_export_table(folder_path, collection_name)
+
+    def items():
+        for batch in table.to_batches(max_chunksize=batch_size):
+            for nft in batch.to_pylist():
+                yield nft['identifier'], nft
+
+    write_json_object(filename, items(), separators=(',', ':'))
+
+def get_shard_filename(sort_key, index):
+    return f'{sort_key}-{index}.json'
+
+shard_sort_keys = ['identifier', 'discount', 'level', 'starLevel', 'priceAmount']
+
+def encode_shard(table):
+    import pyarrow as pa
+    # column oriented, a string column that repeats is stored as indices into a per-shard dictionary
+    columns = {}
+    dictionaries = {}
+    for field in table.schema:
+        values = table.column(field.name).to_pylist()
+        if pa.types.is_string(field.type) or pa.types.is_large_string(field.type):
+            dictionary = list(dict.fromkeys(values))
+            if len(dictionary) < len(values):
+                index = {value: i for i, value in enumerate(dictionary)}
+                dictionaries[field.name] = dictionary
+                values = [index[value] for value in values]
+        columns[field.name] = values
+    return {'count': table.num_rows, 'columns': columns, 'dictionaries': dictionaries}
+
+def export_collection_shards(folder_path, collection_name, shards_folder_path, shard_size=100):
+    import pyarrow.compute as pc
+    # minified pages of the export table once per sort key (ascending, nulls last),
+    # described by manifest.json
+    table = read_export_table(folder_path, collection_name)
+    orders = {key: pc.sort_indices(table, sort_keys=[(key, 'ascending')]) for key in shard_sort_keys if key in table.column_names}
+    manifest = {
+        'collection': collection_name,
+        'count': table.num_rows,
+        'shardSize': shard_size,
+        'columns': table.column_names,
+        'defaultSort': 'discount' if 'discount' in orders else 'identifier',
+        'sorts': {}
+    }
+    tmp_folder_path = f'{shards_folder_path}.tmp'
+    shutil.rmtree(tmp_folder_path, ignore_errors=True)
+    os.makedirs(tmp_folder_path)
+    for key, order in orders.items():
+        sorted_table = table.take(order)
+        shards = []
+        for start in range(0, table.num_rows, shard_size):
+            shard_filename = get_shard_filename(key, start // shard_size)
+            with open(os.path.join(tmp_folder_path, shard_filename), 'w') as f:
+                json.dump(encode_shard(sorted_table.slice(start, shard_size)), f, separators=(',', ':'))
+            shards.append(shard_filename)
+        manifest['sorts'][key] = {
+            'count': table.num_rows - table.column(key).null_count,
+            'shards': shards
+        }
+    with open(os.path.join(tmp_folder_path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, separators=(',', ':'))
+    replace_folder(tmp_folder_path, shards_folder_path)
+
+index_fields = ['name', 'rarityClass']
+
+def write_index_file(filename, data):
+    with open(filename, 'w') as f:
+        json.dump(data, f, separators=(',', ':'))
+
+def export_indexes(folder_path, collection_names, indexes_folder_path, shard_size=100):
+    # per collection, the first identifier of every identifier-sorted shard and one sorted
+    # identifier list per name/rarityClass value; across collections, owner -> identifiers
+    # bucketed by the last (checksum) character of the address
+    tmp_folder_path = f'{indexes_folder_path}.tmp'
+    shutil.rmtree(tmp_folder_path, ignore_errors=True)
+    owners = defaultdict(lambda: defaultdict(list))
+    for collection_name in collection_names:
+        table = read_export_table(folder_path, collection_name)
+        columns = {name: table.column(name).to_pylist() for name in ['identifier', 'owner', *index_fields] if name in table.column_names}
+        order = sorted(range(table.num_rows), key=lambda row: columns['identifier'][row])
+        identifiers = [columns['identifier'][row] for row in order]
+        collection_folder_path = os.path.join(tmp_folder_path, collection_name)
+        os.makedirs(collection_folder_path)
+        write_index_file(os.path.join(collection_folder_path, 'identifiers.json'), {
+            'sort': 'identifier',
+            'shards': [get_shard_filename('identifier', index) for index in range(len(identifiers[::shard_size]))],
+            'first': identifiers[::shard_size]
+        })
+        if 'owner' in columns:
+            for row in order:
+                if columns['owner'][row] is not None:
+                    owners[columns['owner'][row]][collection_name].append(columns['identifier'][row])
+        for field in index_fields:
+            if field not in columns:
+                continue
+            values = defaultdict(list)
+            for row in order:
+                if columns[field][row] is not None:
+                    values[columns[field][row]].append(columns['identifier'][row])
+            field_index = {}
+            for index, (value, value_identifiers) in enumerate(sorted(values.items())):
+                filename = f'{field}-{index}.json'
+                write_index_file(os.path.join(collection_folder_path, filename), value_identifiers)
+                field_index[value] = {'count': len(value_identifiers), 'file': filename}
+            write_index_file(os.path.join(collection_folder_path, f'{field}.json'), field_index)
+    buckets = defaultdict(dict)
+    for owner, owned in owners.items():
+        buckets[owner[-1]][owner] = owned
+    os.makedirs(os.path.join(tmp_folder_path, 'owners'), exist_ok=True)
+    for bucket, bucket_owners in buckets.items():
+        write_index_file(os.path.join(tmp_folder_path, 'owners', f'{bucket}.json'), bucket_owners)
+    replace_folder(tmp_folder_path, indexes_folder_path)
+
+async def async_get_nft_transfers(identifier, semaphores, user_agent, sleep_time=0.4, chunk_size=50, after=None, known=0):
+    # newest first; with after, only the transfers from that timestamp on, of which known are
+    # already stored, so no page is fetched when the count did not grow
+    query = f'token={identifier}' if after is None else f'token={identifier}&after={after}'
+    url = f'https://api.elrond.com/transfers/count?{query}'
+    count = await async_get_json(url, semaphores, user_agent, sleep_time) or 0
+    if count <= known:
+        return []
+    urls = [f'https://api.elrond.com/transfers?from={index}&size={chunk_size}&{query}&withScamInfo=true&withUsername=true&withBlockInfo=true' for index in range(0, count, chunk_size)]
+    pages = await asyncio.gather(*[async_get_json(url, semaphores, user_agent, sleep_time) for url in urls])
+    return [transaction for page in pages for transaction in page or []]
+
+def index_collection_txs(filename):
+    # byte offset and newest transfer timestamp of the latest record of every identifier
+    offsets = {}
+    marks = {}
+    if not os.path.exists(filename):
+        return offsets, marks
+    with open(filename, 'rb') as f:
+        offset = 0
+        for line in f:
+            try:
+                record = json.loads(line)
+                offsets[record['identifier']] = offset
+                marks[record['identifier']] = record.get('lastTimestamp')
+            except ValueError:
+                pass
+            offset += len(line)
+    return offsets, marks
+
+async def async_get_collection_txs(collection_name, identifiers, journal_filename, sleep_time=0.4, chunk_size=50, workers=16):
+    # identifiers go through a bounded queue to a fixed number of workers, so only that many
+    # histories are in flight; an identifier already in the journal only fetches transfers from
+    # its newest timestamp on, merged with the stored ones by hash, and is appended again only
+    # when something new turned up
+    user_agent = get_user_agent()
+    semaphores = get_semaphores()
+    offsets, marks = index_collection_txs(journal_filename)
+    identifier_queue = asyncio.Queue(workers * 2)
+    bar = tqdm(total=len(identifiers), desc=f"get_collection_txs('{collection_name}')", position=0)
+    updated = 0
+    with open_journal(journal_filename) as journal:
+        async def produce():
+            for identifier in identifiers:
+                await identifier_queue.put(identifier)
+            for _ in range(workers):
+                await identifier_queue.put(None)
+
+        async def work():
+            nonlocal updated
+            while True:
+                identifier = await identifier_queue.get()
+                if identifier is None:
+                    return
+                mark = marks.get(identifier)
+                previous = next(read_jsonl_at(journal_filename, offsets, [identifier]))['transactions'] if identifier in offsets else None
+                known = len([transaction for transaction in previous if transaction['timestamp'] >= mark]) if mark is not None else 0
+                transactions = await async_get_nft_transfers(identifier, semaphores, user_agent, sleep_time, chunk_size, mark, known)
+                if previous is not None:
+                    hashes = set([transaction['txHash'] for transaction in previous])
+                    new_transactions = [transaction for transaction in transactions if transaction['txHash'] not in hashes]
+                    transactions = new_transactions + previous
                 else:
-                    for key, value in data['gameData'][-1]['dynamicData'].items():
-                        if key == 'talents':
-                            for attribute in value:
-                                offchain_data[attribute['name']] = attribute['value']
-                        else:
-                            offchain_data[key] = value
-    elif onchain_data['collection'] in ['GSPACEAPE-08bc2b', 'CEA-2d29f9']:
+                    new_transactions = transactions
+                if identifier not in offsets or len(new_transactions) > 0:
+                    last_timestamp = max([transaction['timestamp'] for transaction in transactions], default=None)
+                    append_journal(journal, {'identifier': identifier, 'count': len(transactions), 'lastTimestamp': last_timestamp, 'transactions': transactions})
+                    updated += 1
+                bar.update(1)
+
+        await asyncio.gather(produce(), *[work() for _ in range(workers)])
+    bar.close()
+    return updated
+
+def write_collection_txs(identifiers, filename, journal_filename):
+    # only one identifier's history is in memory at a time
+    offsets = index_jsonl(journal_filename, 'identifier')
+
+    def items():
+        for record in read_jsonl_at(journal_filename, offsets, [identifier for identifier in identifiers if identifier in offsets]):
+            identifier = record.pop('identifier')
+            record.pop('lastTimestamp', None)
+            yield identifier, record
+
+    write_json_object(filename, items())
+
+def compact_jsonl(filename, key):
+    # keeps only the latest record of every key
+    offsets = index_jsonl(filename, key)
+    write_jsonl(filename, read_jsonl_at(filename, offsets, list(offsets)))
+
+def get_collection_txs(collection_name, identifiers, filename, journal_filename=None, sleep_time=0.4, chunk_size=50):
+    # the journal is kept between runs, it is what the next run resumes and updates from
+    journal_filename = journal_filename or f'{filename}.part'
+    updated = run_async(async_get_collection_txs(collection_name, identifiers, journal_filename, sleep_time, chunk_size))
+    if updated > 0:
+        compact_jsonl(journal_filename, 'identifier')
+    write_collection_txs(identifiers, filename, journal_filename)
+
+weapon_dynamic_attributes = ['xp', 'wear', 'level', 'starLevel', 'Damage', 'Reload Time', 'Ammo', 'Range']
+character_trait_attributes = ['Background', 'Body', 'Earrings', 'Eyes', 'Face', 'Head', 'Headgear', 'LegAccessories', 'Legs', 'Mouth', 'Perk 1', 'Perk 2', 'Rarity Class', 'Skin', 'Species']
+character_dynamic_attributes = ['level', 'health', 'shield', 'talent_points_available', 'talent_points_total', 'earn_rate', 'character_tokens', 'Overachiever', 'Hodler', 'Grounded', 'Stonewall', 'Adrenaline Rush', 'Overshield', 'Black Widow', 'Galvanized', 'Nano Meds', 'Resilience', 'Cold Blooded', 'Perseverance', 'Escape Artist', 'Scavenger', 'Cool Moves', 'Brawler', 'Automatic Weapons Proficiency', 'Scatter Weapons Proficiency', 'Precision Weapons Proficiency', 'Explosive Weapons Proficiency', 'Elemental Weapons Proficiency']
+
+def extract_weapon_dynamic(data, offchain_data):
+    for key, value in data.items():
+        if key == 'stats':
+            for attribute in value:
+                offchain_data[attribute['name']] = attribute['value']
+        else:
+            offchain_data[key] = value
+
+def extract_character_traits(data, offchain_data):
+    for attribute in data['attributes']:
+        offchain_data[attribute['trait_type']] = attribute['value']
+
+def extract_character_dynamic(data, offchain_data):
+    for key, value in data['gameData'][-1]['dynamicData'].items():
+        if key == 'talents':
+            for attribute in value:
+                offchain_data[attribute['name']] = attribute['value']
+        else:
+            offchain_data[key] = value
+
+# per collection: the off-chain url prefixes to read (prefix -> extractor and the attributes nulled when the document is an error)
+# and the on-chain attributes forced to 'None'
+weapon_schema = {
+    'offchain': {
+        'https://metadata.cantinaroyale.io/dynamic/': (extract_weapon_dynamic, weapon_dynamic_attributes)
+    }
+}
+hero_schema = {
+    'offchain': {
+        'https://metadata.cantinaroyale.io/metadata/': (extract_character_traits, character_trait_attributes),
+        'https://metadata.cantinaroyale.io/dynamic/': (extract_character_dynamic, character_dynamic_attributes)
+    }
+}
+genesis_schema = {
+    'offchain': {
+        'https://metadata.verko.io/dynamic/': (extract_character_dynamic, character_dynamic_attributes)
+    }
+}
+collection_schemas = {
+    'CRMYTH-546419': weapon_schema,
+    'CRWEAPONS-e5ab49': weapon_schema,
+    'CRCHAMPS-d0265d': hero_schema,
+    'CRHEROES-9edff2': hero_schema,
+    'GSPACEAPE-08bc2b': genesis_schema,
+    'CEA-2d29f9': genesis_schema,
+    'EAPES-8f3c1f': {
+        'onchain_defaults': ['Background', 'Type', 'Eyes', 'Mouth', 'Clothes', 'Earring', 'priceCurrency', 'priceAmount', 'Hat', 'Special']
+    }
+}
+nft_parsers = {}
+
+@lru_cache(maxsize=None)
+def camel_case(key):
+    new_key = key.replace('_', ' ').split(' ')
+    new_key = ''.join([word[0].upper()+word[1:] for word in new_key])
+    return new_key[0].lower() + new_key[1:]
+
+def get_url_prefix(url):
+    # scheme://host/first-segment/, the granularity every schema prefix is declared at
+    return url[:url.find('/', url.find('/', 8) + 1) + 1]
+
+def compile_nft_parser(schema):
+    onchain_defaults = dict.fromkeys(schema.get('onchain_defaults', []), 'None')
+    extractors = {prefix: (extractor, dict.fromkeys(attributes)) for prefix, (extractor, attributes) in schema.get('offchain', {}).items()}
+
+    def parse(nft):
+        # onchain data
+        onchain_data = {}
+        onchain_data['identifier'] = nft.get('identifier', None)
+        onchain_data['collection'] = nft.get('collection', None)
+        onchain_data['name'] = nft.get('name', None)
+        onchain_data['url'] = nft['media'][-1].get('url', None) if nft.get('media', []) != [] else None
+        onchain_data['thumbnailUrl'] = nft['media'][-1].get('thumbnailUrl', None) if nft.get('media', []) != [] else None
+        onchain_data['owner'] = nft.get('owner', None)
+        onchain_data['rank'] = nft.get('rank', None)
+        if nft['metadata'] != {}:
+            for attribute in nft['metadata'].get('attributes', []):
+                onchain_data[attribute['trait_type']] = attribute['value']
+        onchain_data.update(onchain_defaults)
+        # offchain data
+        offchain_data = {}
+        offchain_data['priceCurrency'] = nft['offchainData']['price']['currency']
+        offchain_data['priceAmount'] = nft['offchainData']['price']['amount']
+        # only set when some of the offchain data could not be refreshed this run
+        if nft['offchainData'].get('stale'):
+            offchain_data['stale'] = True
         for url, data in nft['offchainData'].items():
-            if url.startswith('https://metadata.verko.io/dynamic/'):
-                if 'error' in data:
-                    for attibute in ['level', 'health', 'shield', 'talent_points_available', 'talent_points_total', 'earn_rate', 'character_tokens', 'Overachiever', 'Hodler', 'Grounded', 'Stonewall', 'Adrenaline Rush', 'Overshield', 'Black Widow', 'Galvanized', 'Nano Meds', 'Resilience', 'Cold Blooded', 'Perseverance', 'Escape Artist', 'Scavenger', 'Cool Moves', 'Brawler', 'Automatic Weapons Proficiency', 'Scatter Weapons Proficiency', 'Precision Weapons Proficiency', 'Explosive Weapons Proficiency', 'Elemental Weapons Proficiency']:
-                        offchain_data[attibute] = None
-                else:
-                    for key, value in data['gameData'][-1]['dynamicData'].items():
-                        if key == 'talents':
-                            for attribute in value:
-                                offchain_data[attribute['name']] = attribute['value']
-                        else:
-                            offchain_data[key] = value
-    nft_data = {**onchain_data, **offchain_data}
-    new_nft_data = {}
-    for key, value in nft_data.items():
-        new_key = key.replace('_', ' ').split(' ')
-        new_key = ''.join([word[0].upper()+word[1:] for word in new_key])
-        new_key = new_key[0].lower() + new_key[1:]
-        new_nft_data[new_key] = value if value != "None" else None
-    return new_nft_data
+            extractor = extractors.get(get_url_prefix(url))
+            if extractor is None:
+                continue
+            if 'error' in data:
+                offchain_data.update(extractor[1])
+            else:
+                extractor[0](data, offchain_data)
+        nft_data = {**onchain_data, **offchain_data}
+        return {camel_case(key): value if value != "None" else None for key, value in nft_data.items()}
+
+    return parse
+
+def get_nft_parser(collection):
+    if collection not in nft_parsers:
+        nft_parsers[collection] = compile_nft_parser(collection_schemas.get(collection, {}))
+    return nft_parsers[collection]
 
+def parse_nft_data(nft):
+    return get_nft_parser(nft.get('collection', None))(nft)
+
+def fill_floor_prices(rarities, percent_column, seed_floor_price):
+    import numpy as np
+    # a missing floor price is scaled by supply from the nearest listed entry before it,
+    # or from the first listed entry when none comes before; with nothing listed the most
+    # common entry is seeded with seed_floor_price
+    floor_price = rarities['floorPrice'].to_numpy(dtype=float)
+    percent = rarities[percent_column].to_numpy(dtype=float)
+    listed = floor_price > 0
+    seeded = not listed.any()
+    if seeded:
+        seed = rarities.index.get_loc(rarities.sort_values(percent_column, ascending=False).index[0])
+        floor_price = floor_price.copy()
+        floor_price[seed] = seed_floor_price
+        listed[seed] = True
+    positions = np.arange(len(floor_price))
+    source = np.maximum.accumulate(np.where(listed, positions, -1))
+    source = np.where(source == -1, positions[listed][0], source)
+    floor_price = np.where(listed, floor_price, percent[source] / percent * floor_price[source])
+    if seeded:
+        # keep the seed exactly as given so market_data.json writes 5 rather than 5.0
+        floor_price = floor_price.astype(object)
+        floor_price[seed] = seed_floor_price
+    rarities = rarities.copy()
+    rarities['floorPrice'] = floor_price
+    if seeded:
+        rarities = rarities.sort_values(percent_column, ascending=False)
+    return rarities
 
+market_data_lock = threading.Lock()
 
+def get_crt_egld_rate(data_folder_path=None):
+    from bs4 import BeautifulSoup
+
+    # read from the page's ld+json; when it cannot be, the rate market_data.json was last written with
+    url = 'https://coindataflow.com/en/pair/crt-wegld'
+    try:
+        response = get_with_retries(url, get_user_agent(), accept=(200,))
+        soup = BeautifulSoup(response.text, 'html.parser')
+        script_tag = soup.find('script', type='application/ld+json')
+        if script_tag is None or script_tag.string is None:
+            raise FetchError(f'{url}: no ld+json script')
+        json_data = json.loads(script_tag.string)
+        return float(json_data['currentExchangeRate']['price'])
+    except (FetchError, ValueError, KeyError, TypeError) as e:
+        filename = os.path.join(data_folder_path, 'market_data.json') if data_folder_path is not None else None
+        if filename is None or not os.path.exists(filename):
+            raise FetchError(f'{url}: no CRT/EGLD rate ({e}) and no previous one') from e
+        with open(filename) as f:
+            crt_egld_rate = json.load(f).get('CRT/EGLD')
+        if crt_egld_rate is None:
+            raise FetchError(f'{url}: no CRT/EGLD rate ({e}) and no previous one') from e
+        print(f'{url}: no CRT/EGLD rate ({e}), keeping the previous one {crt_egld_rate}')
+        record_stale()
+        return crt_egld_rate
 
+def add_market_data(data_folder_path, collections, nfts_folder_path, character_seed_floor_price=5, weapon_seed_floor_price=None, crt_egld_rate=None):
+    import pandas as pd
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.parquet as pq
 
+    if weapon_seed_floor_price is None:
+        weapon_seed_floor_price = {'CRMYTH-546419': 1, 'default': 0.1}
 
-def add_market_data(data_folder_path, collections):
+    # upgrade costs summed over levels 1..level, indexed by level, so whole columns are valued at once
+    def get_upgrade_cumsum(upgrade, key):
+        return np.cumsum([0] + [upgrade['nft'][str(l)][key] for l in range(1, len(upgrade['nft'])+1)])
 
     def get_character_value(floor_price, level, tokens):
         shard_conversion = 1
         token_conversion = 200
-        shards = 0
-        crown = 0
-        for l in range(1, level+1):
-            shards += characters_upgrade['nft'][str(l)]['shards']
-            tokens += characters_upgrade['nft'][str(l)]['tokens']
-            crown += characters_upgrade['nft'][str(l)]['crown']
+        shards = characters_shards[level]
+        tokens = tokens + characters_tokens[level]
+        crown = characters_crown[level]
         shards = shards * shard_conversion /100 * crt_egld_rate
         crown = crown /100 * crt_egld_rate
         tokens = tokens * token_conversion /100 * crt_egld_rate
@@ -367,74 +1884,36 @@ def add_market_data(data_folder_path, collections):
         shard_conversion = 1
         token_conversion = 200
         max_level = 20
-        max_tokens = 0
-        for l in range(1, max_level+1):
-            max_tokens += characters_upgrade['nft'][str(l)]['tokens']
+        max_tokens = characters_tokens[max_level]
         def foo(level, tokens):
-            shards = 0
-            crown = 0
-            for l in range(1, level+1):
-                shards += characters_upgrade['nft'][str(l)]['shards']
-                tokens += characters_upgrade['nft'][str(l)]['tokens']
-                crown += characters_upgrade['nft'][str(l)]['crown']
+            shards = characters_shards[level]
+            tokens = tokens + characters_tokens[level]
+            crown = characters_crown[level]
             shards = shards * shard_conversion /100 * crt_egld_rate
             crown = crown /100 * crt_egld_rate
-            tokens = min(tokens, max_tokens) * token_conversion /100 * crt_egld_rate
+            tokens = np.minimum(tokens, max_tokens) * token_conversion /100 * crt_egld_rate
             return shards + tokens + crown
         progress_value = foo(level, tokens) 
         progress_value_total = foo(max_level, 0)
         return (progress_value / progress_value_total) * 100
     
-    def get_character_floorPrice(df):
+    def get_character_floorPrice(df, seed_floor_price):
         rarities = df.value_counts('rarityClass').reset_index()
         rarities['percent'] = rarities['count'] / rarities['count'].sum()
         onsale = df[(~df['priceAmount'].isna()) & (df['priceCurrency']=='EGLD')]
         rarities = pd.merge(rarities, onsale.groupby('rarityClass').agg({'priceAmount':'min'}).reset_index().rename(columns={'priceAmount':'floorPrice'}), on='rarityClass', how='outer')
         rarities = rarities.fillna(0)
-        rarities_dict = rarities.to_dict(orient='index')
-        while True:
-            last = -1
-            for index in range(len(rarities_dict)):
-                if rarities_dict[index]['floorPrice'] > 0:
-                    last = index
-                if last != -1 and rarities_dict[index]['floorPrice'] == 0:
-                    rarities_dict[index]['floorPrice'] = rarities_dict[last]['percent']/rarities_dict[index]['percent'] * rarities_dict[last]['floorPrice']
-            last = -1
-            for index in range(len(rarities_dict)-1, -1, -1):
-                if rarities_dict[index]['floorPrice'] > 0:
-                    last = index
-                if last != -1 and rarities_dict[index]['floorPrice'] == 0:
-                    rarities_dict[index]['floorPrice'] = rarities_dict[last]['percent']/rarities_dict[index]['percent'] * rarities_dict[last]['floorPrice']
-            rarities = pd.DataFrame(rarities_dict).T
-            if rarities[rarities['floorPrice']==0].shape[0] > 0:
-                rarities = rarities.sort_values('percent', ascending=False)
-                rarities.iloc[0, rarities.columns.get_loc('floorPrice')] = 5
-                rarities_dict = rarities.to_dict(orient='index')
-            else:
-                break
+        rarities = fill_floor_prices(rarities, 'percent', seed_floor_price)
         rarities = rarities.set_index('rarityClass')
         rarities = rarities.to_dict(orient='index')
         return rarities
     
     def get_weapon_value(floor_price, starLevel, level, tokens):
-        shards_fusion = {
-            1: 0,
-            2: 1000,
-            3: 6000,
-            4: 35000,
-            5: 100000,
-            6: 500000
-        }
         shard_conversion = 1
         token_conversion = 50
-        shards = 0
-        crown = 0
-        for l in range(1, starLevel+1):
-            shards += shards_fusion[l]
-        for l in range(1, level+1):
-            shards += weapons_upgrade['nft'][str(l)]['shards']
-            # tokens += weapons_upgrade['nft'][str(l)]['tokens']
-            crown += weapons_upgrade['nft'][str(l)]['crown']
+        shards = weapons_fusion_shards[starLevel] + weapons_shards[level]
+        # tokens = tokens + weapons_tokens[level]
+        crown = weapons_crown[level]
         shards = shards * shard_conversion /100 * crt_egld_rate
         crown = crown /100 * crt_egld_rate
         tokens = tokens * token_conversion /100 * crt_egld_rate
@@ -447,21 +1926,18 @@ def add_market_data(data_folder_path, collections):
         max_level = 20
         max_tokens = weapons_upgrade['nft'][str(max_level)]['tokens']
         def foo(level, tokens):
-            shards = 0
-            crown = 0
-            for l in range(1, level+1):
-                shards += weapons_upgrade['nft'][str(l)]['shards']
-                # tokens += weapons_upgrade['nft'][str(l)]['tokens']
-                crown += weapons_upgrade['nft'][str(l)]['crown']
+            shards = weapons_shards[level]
+            # tokens = tokens + weapons_tokens[level]
+            crown = weapons_crown[level]
             shards = shards * shard_conversion /100 * crt_egld_rate
             crown = crown /100 * crt_egld_rate
-            tokens = min(tokens, max_tokens) * token_conversion /100 * crt_egld_rate
+            tokens = np.minimum(tokens, max_tokens) * token_conversion /100 * crt_egld_rate
             return shards + tokens + crown
         progress_value = foo(level, tokens) 
         progress_value_total = foo(max_level, max_tokens)
         return (progress_value / progress_value_total) * 100
     
-    def get_weapon_floorPrice(df):
+    def get_weapon_floorPrice(df, seed_floor_price):
         def foo(starlevel):
             starlevel = int(starlevel)
             result = 1
@@ -478,78 +1954,83 @@ def add_market_data(data_folder_path, collections):
         rarities = rarities.sort_values('countStarLevel1%', ascending=False).reset_index(drop=True)
         rarities = rarities.fillna(0)
         rarities = rarities.rename(columns={'countStarLevel1':'count1*', 'countStarLevel1%':'percent1*'})
-        rarities_dict = rarities.to_dict(orient='index')
-        while True:
-            last = -1
-            for index in range(len(rarities_dict)):
-                if rarities_dict[index]['floorPrice'] > 0:
-                    last = index
-                if last != -1 and rarities_dict[index]['floorPrice'] == 0:
-                    rarities_dict[index]['floorPrice'] = rarities_dict[last]['percent1*']/rarities_dict[index]['percent1*'] * rarities_dict[last]['floorPrice']
-            last = -1
-            for index in range(len(rarities_dict)-1, -1, -1):
-                if rarities_dict[index]['floorPrice'] > 0:
-                    last = index
-                if last != -1 and rarities_dict[index]['floorPrice'] == 0:
-                    rarities_dict[index]['floorPrice'] = rarities_dict[last]['percent1*']/rarities_dict[index]['percent1*'] * rarities_dict[last]['floorPrice']
-            rarities = pd.DataFrame(rarities_dict).T
-            if rarities[rarities['floorPrice']==0].shape[0] > 0:
-                rarities = rarities.sort_values('percent1*', ascending=False)
-                x = 1 if df['collection'].unique()[0] == 'CRMYTH-546419' else 0.1
-                rarities.iloc[0, rarities.columns.get_loc('floorPrice')] = x
-                rarities_dict = rarities.to_dict(orient='index')
-            else:
-                break
+        seed = seed_floor_price.get(df['collection'].unique()[0], seed_floor_price['default'])
+        rarities = fill_floor_prices(rarities, 'percent1*', seed)
         rarities = rarities.set_index('name')
         rarities = rarities.to_dict(orient='index')
         return rarities
 
+    def read_market_columns(collections, columns):
+        # only the columns the market math needs are read from the working store
+        df = pd.concat([read_parquet_columns(get_stage_filename(nfts_folder_path, collection, 'nfts', 'parquet'), columns) for collection in collections])
+        return df.set_index('identifier', drop=False)
+
+    def write_market_columns(df, columns):
+        df = df.sort_values('discount', ascending=True)
+        for collection in df['collection'].unique():
+            collection_df = df[df['collection']==collection]
+            filename = get_stage_filename(nfts_folder_path, collection, 'market', 'parquet')
+            pq.write_table(pa.Table.from_pandas(collection_df[columns], preserve_index=False), f'{filename}.tmp', compression='zstd')
+            os.replace(f'{filename}.tmp', filename)
+
     with open(os.path.join(data_folder_path, 'characters_upgrade.json')) as f:
         characters_upgrade = json.load(f)
     with open(os.path.join(data_folder_path, 'weapons_upgrade.json')) as f:
         weapons_upgrade = json.load(f)
-    genesis = pd.concat([pd.read_json(os.path.join(data_folder_path, collection, 'nfts.json'), orient='index') for collection in collections['genesis']])
-    heroes = pd.concat([pd.read_json(os.path.join(data_folder_path, collection, 'nfts.json'), orient='index') for collection in collections['heroes']])
-    weapons = pd.concat([pd.read_json(os.path.join(data_folder_path, collection, 'nfts.json'), orient='index') for collection in collections['weapons']])
-    weapons = weapons[~weapons['starLevel'].isna()]
-    # get CRT-EGLD rate
-    url = 'https://coindataflow.com/en/pair/crt-wegld'
-    response = requests.get(url)
-    html = response.text
-    soup = BeautifulSoup(html, 'html.parser')
-    script_tag = soup.find('script', type='application/ld+json')
-    json_data = json.loads(script_tag.string)
-    crt_egld_rate = float(json_data['currentExchangeRate']['price'])
-    market_data = {'CRT/EGLD': crt_egld_rate, 'floorPrice': {'genesis': {}, 'heroes': {}, 'weapons': {}}}
+    characters_shards = get_upgrade_cumsum(characters_upgrade, 'shards')
+    characters_tokens = get_upgrade_cumsum(characters_upgrade, 'tokens')
+    characters_crown = get_upgrade_cumsum(characters_upgrade, 'crown')
+    weapons_shards = get_upgrade_cumsum(weapons_upgrade, 'shards')
+    weapons_crown = get_upgrade_cumsum(weapons_upgrade, 'crown')
+    # shards spent fusing up to each star level, index 0 unused
+    weapons_fusion_shards = np.cumsum([0, 0, 1000, 6000, 35000, 100000, 500000])
+    character_columns = ['identifier', 'collection', 'rarityClass', 'level', 'characterTokens', 'priceAmount', 'priceCurrency']
+    weapon_columns = ['identifier', 'collection', 'name', 'starLevel', 'level', 'xp', 'priceAmount', 'priceCurrency']
+    # groups computed by separate calls pass the rate fetched once for all of them
+    if crt_egld_rate is None:
+        crt_egld_rate = get_crt_egld_rate(data_folder_path)
+    floor_prices = {}
     # characters
-    for name, df in [('genesis', genesis), ('heroes', heroes)]:
-        floorPrice = get_character_floorPrice(df)
-        market_data['floorPrice'][name] = floorPrice
-        df['value'] = df.apply(lambda x: get_character_value(floorPrice[x['rarityClass']]['floorPrice'], x['level'], x['characterTokens']), axis=1)
-        df['flag'] = (~df['priceAmount'].isna()) & (df['priceCurrency']=='EGLD')
-        df['discount'] = df.apply(lambda x: x['priceAmount'] - x['value'] if x['flag'] else np.nan, axis=1)
-        df['discount'] = df.apply(lambda x: x['discount'] / x['value'] * 100 if x['flag'] else np.nan, axis=1)
-        df['progress'] = df.apply(lambda x: get_character_progress(x['level'], x['characterTokens']), axis=1)
-        df = df.drop(columns=['flag'])
-        df = df.sort_values('discount', ascending=True)
-        for collection in df['collection'].unique():
-            collection_df = df[df['collection']==collection]
-            collection_df.to_json(os.path.join(data_folder_path, collection, 'nfts.json'), orient='index', indent=4)
+    for name in [name for name in collections if name != 'weapons']:
+        df = read_market_columns(collections[name], character_columns)
+        floorPrice = get_character_floorPrice(df, character_seed_floor_price)
+        floor_prices[name] = floorPrice
+        floor_price = df['rarityClass'].map({rarity: value['floorPrice'] for rarity, value in floorPrice.items()}).to_numpy(dtype=float)
+        level = df['level'].to_numpy(dtype=int)
+        tokens = df['characterTokens'].to_numpy()
+        df['value'] = get_character_value(floor_price, level, tokens)
+        flag = ((~df['priceAmount'].isna()) & (df['priceCurrency']=='EGLD')).to_numpy()
+        df['discount'] = np.where(flag, (df['priceAmount'].to_numpy(dtype=float) - df['value'].to_numpy()) / df['value'].to_numpy() * 100, np.nan)
+        df['progress'] = get_character_progress(level, tokens)
+        write_market_columns(df, ['identifier', 'value', 'discount', 'progress'])
     # weapons
-    for collection in weapons['collection'].unique():
-        df = weapons[weapons['collection']==collection]
-        floorPrice = get_weapon_floorPrice(df)
-        market_data['floorPrice']['weapons'].update(floorPrice)
-    weapons['xp'] = weapons['xp'].astype(int)
-    weapons['starLevel'] = weapons['starLevel'].astype(int)
-    weapons['level'] = weapons['level'].astype(int)
-    weapons['value'] = weapons.apply(lambda x: get_weapon_value(market_data['floorPrice']['weapons'][x['name']]['floorPrice'], x['starLevel'], x['level'], x['xp']), axis=1)
-    weapons['discount'] = weapons.apply(lambda x: x['priceAmount'] - x['value'] if x['priceCurrency']=='EGLD' else np.nan, axis=1)
-    weapons['discount'] = weapons.apply(lambda x: x['discount'] / x['value'] * 100 if x['priceCurrency']=='EGLD' else np.nan, axis=1)
-    weapons['progress'] = weapons.apply(lambda x: get_weapon_progress(x['level'], x['xp']), axis=1)
-    weapons = weapons.sort_values('discount', ascending=True)
-    for collection in weapons['collection'].unique():
-        collection_df = weapons[weapons['collection']==collection]
-        collection_df.to_json(os.path.join(data_folder_path, collection, 'nfts.json'), orient='index', indent=4)
-    with open(os.path.join(data_folder_path, 'market_data.json'), 'w') as f:
-        json.dump(market_data, f, indent=4)
\ No newline at end of file
+    if 'weapons' in collections:
+        weapons = read_market_columns(collections['weapons'], weapon_columns)
+        weapons = weapons[~weapons['starLevel'].isna()]
+        floor_prices['weapons'] = {}
+        for collection in weapons['collection'].unique():
+            df = weapons[weapons['collection']==collection]
+            floorPrice = get_weapon_floorPrice(df, weapon_seed_floor_price)
+            floor_prices['weapons'].update(floorPrice)
+        weapons['xp'] = weapons['xp'].astype(int)
+        weapons['starLevel'] = weapons['starLevel'].astype(int)
+        weapons['level'] = weapons['level'].astype(int)
+        floor_price = weapons['name'].map({name: value['floorPrice'] for name, value in floor_prices['weapons'].items()}).to_numpy(dtype=float)
+        star_level = weapons['starLevel'].to_numpy()
+        level = weapons['level'].to_numpy()
+        xp = weapons['xp'].to_numpy()
+        weapons['value'] = get_weapon_value(floor_price, star_level, level, xp)
+        flag = (weapons['priceCurrency']=='EGLD').to_numpy()
+        weapons['discount'] = np.where(flag, (weapons['priceAmount'].to_numpy(dtype=float) - weapons['value'].to_numpy()) / weapons['value'].to_numpy() * 100, np.nan)
+        weapons['progress'] = get_weapon_progress(level, xp)
+        write_market_columns(weapons, ['identifier', 'xp', 'starLevel', 'level', 'value', 'discount', 'progress'])
+    # groups may be computed by separate calls, each one merges its floor prices into the file
+    filename = os.path.join(data_folder_path, 'market_data.json')
+    with market_data_lock:
+        market_data = {'CRT/EGLD': crt_egld_rate, 'floorPrice': {'genesis': {}, 'heroes': {}, 'weapons': {}}}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                market_data['floorPrice'].update(json.load(f).get('floorPrice', {}))
+        market_data['floorPrice'].update(floor_prices)
+        with open(filename, 'w') as f:
+            json.dump(market_data, f, indent=4)
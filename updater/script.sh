@@ -5,14 +5,34 @@ PRIVATE_DIR="$REPO_DIR/private"
 GIT_REPO_URL="https://$GITHUB_TOKEN@github.com/VincenzoImp/cantinaroyale.tools.git"
 GIT_BRANCH="main"
 VENV_DIR="$PRIVATE_DIR/venv"
+# Stato della sincronizzazione incrementale e cache HTTP, fuori dalla repo per sopravvivere al re-clone
+export STATE_DIR="/app/state"
+export CACHE_DIR="/app/cache"
 
-task () {
+git_login () {
     # Configura Git per usare il token (autenticazione)
     git config --global credential.helper store
     echo "https://$GITHUB_TOKEN@github.com" > ~/.git-credentials
     # Configura l'identità dell'utente Git
     git config --global user.email "$GITHUB_EMAIL"
     git config --global user.name "VincenzoImp"
+}
+
+publish () {
+    cd $REPO_DIR
+    # Commit e push delle modifiche (se ci sono cambiamenti)
+    git add .
+    if git diff-index --quiet HEAD; then
+        echo "Nessuna modifica da committare"
+    else
+        git commit -m "$1: $(date)" || { echo "Commit fallito"; return 1; }
+        # Usa l'URL con il token per il push
+        git push $GIT_REPO_URL $GIT_BRANCH || { echo "Push fallito"; return 1; }
+    fi
+}
+
+task () {
+    git_login
     # Se la directory della repo non esiste, clonala
     cd
     rm -rf $REPO_DIR
@@ -35,34 +55,42 @@ task () {
     fi
     # Esegui lo script Python
     cd $PRIVATE_DIR
-    python3 get_data.py || { echo "Esecuzione di get_data.py fallita"; exit 1; }
-    cd $REPO_DIR
-    # Commit e push delle modifiche (se ci sono cambiamenti)
-    git add .
-    if git diff-index --quiet HEAD; then
-        echo "Nessuna modifica da committare"
-    else
-        git commit -m "Auto-update: $(date)" || { echo "Commit fallito"; exit 1; }
-        # Usa l'URL con il token per il push
-        git push $GIT_REPO_URL $GIT_BRANCH || { echo "Push fallito"; exit 1; }
-    fi
+    # Le fasi fallite o oltre la scadenza lasciano i file della notte precedente, quindi si pubblica comunque ciò che è stato completato
+    python3 get_data.py || echo "get_data.py terminato con errori, pubblico i dati parziali"
+    publish "Auto-update" || exit 1
     # Cleanup
     rm ~/.git-credentials
     # Disattiva l'ambiente virtuale
     deactivate
 }
 
-# Ciclo infinito che esegue il task a mezzanotte
+refresh () {
+    # Aggiorna solo prezzi, tasso CRT/EGLD, value e discount sui dati elaborati dall'ultima esecuzione notturna
+    if [ ! -d "$PRIVATE_DIR" ] || [ ! -d "$VENV_DIR" ]; then
+        echo "Nessuna esecuzione notturna completata, salto l'aggiornamento dei prezzi"
+        return
+    fi
+    git_login
+    cd $REPO_DIR
+    git pull --ff-only $GIT_REPO_URL $GIT_BRANCH || { echo "Pull fallito, salto l'aggiornamento dei prezzi"; rm ~/.git-credentials; return; }
+    source $VENV_DIR/bin/activate
+    cd $PRIVATE_DIR
+    python3 get_data.py --refresh-prices --deadline 1800 || echo "get_data.py --refresh-prices terminato con errori, pubblico i dati parziali"
+    publish "Prices update"
+    rm ~/.git-credentials
+    deactivate
+}
+
+# Ciclo infinito: il task completo a mezzanotte, l'aggiornamento dei prezzi allo scoccare di ogni altra ora
 while true; do
-    current_time=$(date +%s)
-    # Ottieni la data di domani a mezzanotte
-    midnight=$(date -d 'tomorrow 00:00:00' +%s)
-    # Calcola la differenza in secondi tra mezzanotte e l'ora corrente
-    seconds_until_midnight=$((midnight - current_time))
-    # Esegui sleep per il numero di secondi fino a mezzanotte
-    echo "Dormo per $seconds_until_midnight secondi fino a mezzanotte..."
-    sleep $seconds_until_midnight
-    # Esegui il task
-    task
+    # Calcola i secondi fino all'inizio della prossima ora
+    seconds_until_next_hour=$((3600 - 10#$(date +%M) * 60 - 10#$(date +%S)))
+    echo "Dormo per $seconds_until_next_hour secondi fino alla prossima ora..."
+    sleep $seconds_until_next_hour
+    if [ "$(date +%H)" = "00" ]; then
+        task
+    else
+        refresh
+    fi
 done
 